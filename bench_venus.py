@@ -0,0 +1,344 @@
+"""
+Synthetic load benchmark of the MQTT and dbus bridges.
+
+Generates the traffic of a configurable number of Venus devices, feeds
+it to the message handler of a bridge in-process and flushes every
+interval, serializing the written points in the configured format
+instead of uploading them. Reports messages/s, us/message, the flush
+duration and the peak RSS, and compares them with the thresholds in
+bench_thresholds.json to catch regressions:
+
+    python3 bench_venus.py --devices 50 --rate 1 --check
+
+Every bridge is run --repeat times and the best result counts, which
+keeps the noise of a busy host out of the comparison. After a change
+that is meant to move the numbers, record new thresholds on the final
+tree with --save, which stores the results with --margin headroom, and
+commit bench_thresholds.json with the change.
+
+Every bridge runs in its own process, so the peak RSS is its own. The
+dbus bridge is fed ItemsChanged signals through its ServiceMonitor, no
+bus is needed. Where the dbus python modules are missing, stand-ins of
+the dbus value types are used.
+"""
+
+import argparse
+import json
+import logging
+import os
+import random
+import resource
+import subprocess
+import sys
+import time
+import types
+
+THRESHOLDS = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                          'bench_thresholds.json')
+BRIDGES = ('mqtt', 'dbus')
+
+# Paths published by a device of each service, with a typical value.
+# Paths the bridges do not log are included, they have to be filtered.
+DEVICES = {
+    'grid': {
+        'Ac/L1/Power': 1200.0, 'Ac/L2/Power': 800.0, 'Ac/L3/Power': 400.0,
+        'Ac/L1/Voltage': 230.0, 'Ac/L2/Voltage': 231.0, 'Ac/L3/Voltage': 229.0,
+        'Ac/L1/Current': 5.2, 'Ac/L2/Current': 3.5, 'Ac/L3/Current': 1.7,
+        'Ac/Power': 2400.0, 'Ac/Energy/Forward': 12345.6,
+        'Ac/Energy/Reverse': 2345.6, 'Frequency': 50.0,
+        'ProductName': 'Carlo Gavazzi EM24', 'CustomName': 'Grid meter',
+        'Connected': 1.0, 'DeviceType': 71.0,
+    },
+    'solarcharger': {
+        'Pv/V': 95.3, 'Pv/I': 6.1, 'Dc/0/Voltage': 53.2, 'Dc/0/Current': 10.9,
+        'Yield/Power': 580.0, 'Yield/User': 1234.5, 'Yield/System': 1234.5,
+        'ErrorCode': 0.0, 'State': 3.0, 'ProductName': 'SmartSolar MPPT 150/35',
+        'CustomName': 'Roof east', 'Mgmt/Connection': 'VE.Direct',
+    },
+    'battery': {
+        'Dc/0/Voltage': 53.1, 'Dc/0/Current': -12.3, 'Dc/0/Power': -653.0,
+        'Dc/0/Temperature': 21.5, 'Soc': 78.0, 'System/MaxCellVoltage': 3.33,
+        'System/MinCellVoltage': 3.31, 'System/MaxVoltageCellId': 'C7',
+        'System/MinVoltageCellId': 'C2', 'Info/MaxChargeCurrent': 100.0,
+        'Info/MaxChargeVoltage': 55.2, 'Info/MaxDischargeCurrent': 150.0,
+        'Info/BatteryLowVoltage': 46.0, 'Alarms/LowVoltage': 0.0,
+    },
+    'vebus': {
+        'Ac/ActiveIn/L1/P': 300.0, 'Ac/Out/L1/P': 650.0, 'Ac/Out/L1/V': 230.1,
+        'Ac/Out/L1/I': 2.8, 'Ac/Out/L1/F': 50.0, 'Dc/0/Voltage': 53.0,
+        'Dc/0/Current': -14.0, 'Energy/AcIn1ToAcOut': 345.6,
+        'Energy/AcIn1ToInverter': 45.6, 'Energy/InverterToAcOut': 456.7,
+        'Energy/OutToInverter': 12.3, 'Mode': 3.0, 'State': 9.0,
+    },
+    'temperature': {
+        'Temperature': 19.5, 'Status': 0.0, 'CustomName': 'Outside',
+        'ProductName': 'Temperature sensor',
+    },
+}
+
+
+class Message:
+    """The attributes of a paho MQTTMessage the bridge reads."""
+
+    __slots__ = ('topic', 'payload')
+
+    def __init__(self, topic, payload):
+        self.topic = topic
+        self.payload = payload
+
+
+class Serializer:
+    """Takes the place of the BatchSender and only serializes batches."""
+
+    def __init__(self, fmt):
+        self._format = fmt
+        self.points = 0
+        self.bytes = 0
+
+    def submit(self, points, rp=None):
+        self.points += len(points)
+        self.bytes += len(self._format.serialize(points))
+        return True
+
+
+def stub_dbus():
+    """Install stand-ins of the dbus and gi modules the bridge imports.
+
+    The bridge only touches the bus in start(), the value types are all
+    unwrap() needs.
+    """
+    dbus = types.ModuleType('dbus')
+    for name, base in (('Array', list), ('Dictionary', dict), ('Double', float),
+                       ('Boolean', int), ('Byte', int), ('Int16', int),
+                       ('UInt16', int), ('Int32', int), ('UInt32', int),
+                       ('Int64', int), ('UInt64', int), ('String', str),
+                       ('ObjectPath', str), ('Signature', str)):
+        setattr(dbus, name, type(name, (base,), {}))
+    gi = types.ModuleType('gi')
+    gi.repository = types.ModuleType('gi.repository')
+    gi.repository.GLib = types.ModuleType('GLib')
+    sys.modules.update({'dbus': dbus, 'gi': gi, 'gi.repository': gi.repository})
+
+
+def devices(n, portals):
+    """Return (portal, service, instance, {path: value}) of n devices."""
+    kinds = sorted(DEVICES)
+    result = []
+    for i in range(n):
+        kind = kinds[i % len(kinds)]
+        portal = 'c0619ab%05x' % (i % portals)
+        result.append((portal, kind, str(i // len(kinds)), DEVICES[kind]))
+    return result
+
+
+def noisy(value, rnd):
+    if type(value) == str:
+        return value
+    return value + value * rnd.uniform(-0.02, 0.02)
+
+
+def mqtt_traffic(fleet, samples, rnd):
+    """Return the messages and their number."""
+    messages = []
+    for _ in range(samples):
+        for portal, kind, instance, paths in fleet:
+            for path, value in paths.items():
+                messages.append(Message(
+                    'N/%s/%s/%s/%s' % (portal, kind, instance, path),
+                    json.dumps({'value': noisy(value, rnd)}).encode()))
+    return messages, len(messages)
+
+
+def dbus_services(fleet):
+    """Return the unique bus name and service name of every device."""
+    return [(':1.%d' % i, 'com.victronenergy.%s.ttyS%s' % (kind, instance))
+            for i, (portal, kind, instance, paths) in enumerate(fleet)]
+
+
+def dbus_traffic(fleet, samples, rnd):
+    """Return an ItemsChanged signal per device and sample, and the items."""
+    import dbus
+    signals = []
+    items = 0
+    senders = dbus_services(fleet)
+    for _ in range(samples):
+        for (sender, service), (portal, kind, instance, paths) in zip(senders, fleet):
+            changes = {}
+            for path, value in paths.items():
+                value = noisy(value, rnd)
+                wrapped = dbus.String(value) if type(value) == str else dbus.Double(value)
+                changes[dbus.ObjectPath('/' + path)] = dbus.Dictionary(
+                        {'Value': wrapped, 'Text': dbus.String(value)})
+            signals.append((dbus.Dictionary(changes), sender))
+            items += len(changes)
+    return signals, items
+
+
+def make_bridge(name, args):
+    kwargs = dict(dryrun=False, wire_format=args.format, tiers=None)
+    if name == 'mqtt':
+        from venus_mqtt_influx import INTERVAL, MqttToIngest
+        bridge = MqttToIngest(**kwargs)
+        feed = lambda msg: bridge.on_message(None, None, msg)
+        traffic = mqtt_traffic
+    else:
+        try:
+            import dbus
+        except ImportError:
+            stub_dbus()
+        from venus_dbus_influx import INTERVAL, DbusToIngest, ServiceMonitor
+        bridge = DbusToIngest('c0619ab00000', **kwargs)
+        # What start() sets up, with the services already loaded.
+        monitor = ServiceMonitor(None, bridge.values_changed_on_dbus)
+        fleet = devices(args.devices, args.portals)
+        for (sender, service), (portal, kind, instance, paths) in zip(
+                dbus_services(fleet), fleet):
+            monitor._owners[sender] = service
+            monitor._instances[service] = int(instance)
+        feed = lambda signal: monitor.items_changed(*signal)
+        traffic = dbus_traffic
+    bridge._uploader = Serializer(bridge._format)
+    return bridge, feed, traffic, INTERVAL
+
+
+def run(name, args):
+    """Benchmark one bridge in this process and return the results."""
+    logging.getLogger().setLevel(logging.WARNING)
+    rnd = random.Random(42)
+    bridge, feed, traffic, interval = make_bridge(name, args)
+    fleet = devices(args.devices, args.portals)
+    samples = max(1, int(round(interval * args.rate)))
+    handled = 0
+    handle_time = 0
+    flushes = []
+    start = 1700000000 - 1700000000 % interval
+    for i in range(args.intervals):
+        messages, n = traffic(fleet, samples, rnd)
+        t = time.perf_counter()
+        for msg in messages:
+            feed(msg)
+        handle_time += time.perf_counter() - t
+        handled += n
+        t = time.perf_counter()
+        bridge.write(start + i * interval, start + (i + 1) * interval)
+        flushes.append(time.perf_counter() - t)
+    return {
+        'bridge': name,
+        'devices': args.devices,
+        'rate': args.rate,
+        'intervals': args.intervals,
+        'messages': handled,
+        'msgs_per_s': round(handled / handle_time),
+        'us_per_msg': round(handle_time / handled * 1e6, 2),
+        'flush_ms_avg': round(sum(flushes) / len(flushes) * 1000, 2),
+        'flush_ms_max': round(max(flushes) * 1000, 2),
+        'points': bridge._uploader.points,
+        'bytes': bridge._uploader.bytes,
+        'peak_rss_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+    }
+
+
+def run_isolated(name, argv):
+    out = subprocess.run([sys.executable, os.path.abspath(__file__),
+                          '--bridge', name, '--json'] + argv,
+                         stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    if out.returncode:
+        error = out.stderr.decode().strip().splitlines()[-1]
+        if not error.startswith('ModuleNotFoundError'):
+            sys.stderr.write(out.stderr.decode())
+            sys.exit('%s bridge failed: %s' % (name, error))
+        return {'bridge': name, 'skipped': error}
+    return json.loads(out.stdout)
+
+
+def best_of(name, argv, repeat):
+    """Run a bridge repeat times, keep the best of every measurement."""
+    runs = [run_isolated(name, argv) for _ in range(repeat)]
+    best = runs[0]
+    if 'skipped' in best:
+        return best
+    for r in runs[1:]:
+        best['msgs_per_s'] = max(best['msgs_per_s'], r['msgs_per_s'])
+        for key in ('us_per_msg', 'flush_ms_avg', 'flush_ms_max', 'peak_rss_mb'):
+            best[key] = min(best[key], r[key])
+    return best
+
+
+def check(results, thresholds, scenario):
+    """Return the list of results worse than their threshold."""
+    if thresholds.get('scenario') != scenario:
+        print('Thresholds were recorded for %s, not checking' % thresholds.get('scenario'))
+        return []
+    failures = []
+    for r in results:
+        limits = thresholds.get(r['bridge'], {})
+        for key, limit in sorted(limits.items()):
+            if key in r and r[key] > limit:
+                failures.append('%s %s %s > %s' % (r['bridge'], key, r[key], limit))
+    return failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the bridges with synthetic Venus traffic.')
+    parser.add_argument('--bridge', choices=BRIDGES + ('all',), default='all')
+    parser.add_argument('--devices', help='Devices across all portals', type=int, default=50)
+    parser.add_argument('--portals', help='GX devices the devices belong to', type=int, default=1)
+    parser.add_argument('--rate', help='Updates per path and second', type=float, default=1)
+    parser.add_argument('--intervals', help='Flush intervals to run', type=int, default=6)
+    parser.add_argument('--format', help='Wire format to serialize', choices=('json', 'line'), default='json')
+    parser.add_argument('--check', action='store_true', help='fail if a threshold is exceeded')
+    parser.add_argument('--save', action='store_true',
+                        help='store the results times --margin as the thresholds')
+    parser.add_argument('--margin', help='Headroom of saved thresholds', type=float, default=1.4)
+    parser.add_argument('--repeat', help='Runs per bridge, the best one counts', type=int, default=3)
+    parser.add_argument('--json', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.json:
+        print(json.dumps(run(args.bridge, args)))
+        return
+
+    argv = ['--devices', str(args.devices), '--portals', str(args.portals),
+            '--rate', str(args.rate), '--intervals', str(args.intervals),
+            '--format', args.format]
+    bridges = BRIDGES if args.bridge == 'all' else (args.bridge,)
+    results = [best_of(name, argv, args.repeat) for name in bridges]
+    for r in results:
+        if 'skipped' in r:
+            print('%-5s skipped: %s' % (r['bridge'], r['skipped']))
+            continue
+        print('%(bridge)-5s %(messages)d msgs %(msgs_per_s)d msgs/s %(us_per_msg).2fus/msg '
+              'flush %(flush_ms_avg).2fms avg %(flush_ms_max).2fms max '
+              '%(points)d points %(bytes)d bytes peak RSS %(peak_rss_mb).1fMB' % r)
+    results = [r for r in results if 'skipped' not in r]
+
+    scenario = {'devices': args.devices, 'portals': args.portals,
+                'rate': args.rate, 'intervals': args.intervals,
+                'format': args.format}
+    if args.save:
+        thresholds = {'scenario': scenario}
+        if os.path.exists(THRESHOLDS):
+            # Keep the thresholds of bridges not run this time.
+            with open(THRESHOLDS) as f:
+                saved = json.load(f)
+            if saved.get('scenario') == scenario:
+                thresholds = saved
+        for r in results:
+            thresholds[r['bridge']] = dict(
+                (key, round(r[key] * args.margin, 2))
+                for key in ('us_per_msg', 'flush_ms_max', 'peak_rss_mb'))
+        with open(THRESHOLDS, 'w') as f:
+            json.dump(thresholds, f, indent=2, sort_keys=True)
+            f.write('\n')
+        print('Saved thresholds to %s' % THRESHOLDS)
+    if args.check:
+        with open(THRESHOLDS) as f:
+            failures = check(results, json.load(f), scenario)
+        for failure in failures:
+            print('REGRESSION %s' % failure)
+        if failures:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
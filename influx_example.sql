@@ -20,6 +20,11 @@ CREATE RETENTION POLICY "30d" ON "victron" DURATION 30d REPLICATION 1
 CREATE RETENTION POLICY "365d" ON "victron" DURATION 365d REPLICATION 1
 CREATE RETENTION POLICY "inf" ON "victron" DURATION INF REPLICATION 1
 
+-- The continuous queries below are not needed if the bridge runs with
+--   --tiers 60:30d,300:365d,600:inf
+-- which writes the downsampled mean/min/max to these retention policies
+-- itself. Drop them in that case.
+
 DROP CONTINUOUS QUERY "cq_30d" ON "victron";
 CREATE CONTINUOUS QUERY "cq_30d" ON "victron"
 -- consider RESAMPLE FOR 5m
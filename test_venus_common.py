@@ -0,0 +1,162 @@
+"""
+Unit tests of the building blocks in venus_common.
+
+    python3 -m unittest test_venus_common
+"""
+
+import unittest
+
+from venus_common import Compressor, SeriesRegistry, TimerWheel, TopicMatcher
+
+
+class CompressorTest(unittest.TestCase):
+
+    def setUp(self):
+        self.series = SeriesRegistry().get('Dc.0.Power', 'Dc/0/Power',
+                                           'c0619ab00000', '0')
+
+    def rewrites(self, compressor, start, end, step=10):
+        """Return the times of the points expire() writes in (start, end]."""
+        times = []
+        for t in range(start + step, end + 1, step):
+            times += [time for series, time, value in compressor.expire(t)]
+        return times
+
+    def test_constant_series_keeps_its_heartbeat(self):
+        compressor = Compressor(heartbeats={'*': 600})
+        self.assertEqual(len(compressor.add(self.series, 1000, 'Fronius')), 1)
+        # A rewrite at most every 1.1 TTL, the jitter included.
+        times = self.rewrites(compressor, 1000, 1000 + 30 * 660 + 10)
+        self.assertGreaterEqual(len(times), 30)
+        self.assertEqual(compressor.stats['forgotten'], 0)
+
+    def test_heartbeat_follows_the_write_by_a_ttl(self):
+        registry = SeriesRegistry()
+        compressor = Compressor(heartbeats={'*': 3600})
+        for i in range(50):
+            series = registry.get('Power', 'Power', 'c0619ab00000', str(i))
+            compressor.add(series, 1000 + i * 10, 42.0)
+        for t in range(1010, 1000 + 3 * 3600, 10):
+            for series, time, value in compressor.expire(t):
+                written = 1000 + int(series.instance) * 10
+                self.assertGreaterEqual(time - written, 3600)
+                self.assertLessEqual(time - written, 3600 * 1.1 + 10)
+                # Only the first rewrite is checked.
+                compressor.forget(series)
+        self.assertEqual(compressor.stats['forgotten'], 50)
+
+    def test_max_rewrites_forgets_series(self):
+        compressor = Compressor(heartbeats={'*': 600}, max_rewrites=24)
+        compressor.add(self.series, 1000, 42.0)
+        times = self.rewrites(compressor, 1000, 1000 + 30 * 600)
+        self.assertEqual(len(times), 24)
+        self.assertEqual(compressor.stats['forgotten'], 1)
+
+    def test_forget_cancels_heartbeat(self):
+        compressor = Compressor(heartbeats={'*': 600})
+        compressor.add(self.series, 1000, 42.0)
+        compressor.forget(self.series)
+        self.assertEqual(self.rewrites(compressor, 1000, 3000), [])
+
+
+class SwingingDoorTest(unittest.TestCase):
+
+    def setUp(self):
+        self.series = SeriesRegistry().get('Dc.0.Power', 'Dc/0/Power',
+                                           'c0619ab00000', '0')
+        self.compressor = Compressor({'*': (1, 0)}, swinging_door=True)
+
+    def add(self, samples):
+        points = []
+        for time, value in samples:
+            points += self.compressor.add(self.series, time, value)
+        return [(time, value) for series, time, value in points]
+
+    def test_ramp_is_written_as_its_end_points(self):
+        ramp = [(t, float(t)) for t in range(0, 101, 10)]
+        self.assertEqual(self.add(ramp + [(110, 50.0)]), [(0, 0.0), (100, 100.0)])
+
+    def test_held_value_is_written_on_expiry(self):
+        self.add([(0, 0.0), (10, 10.0)])
+        points = self.compressor.expire(10000)
+        self.assertEqual([(t, v) for s, t, v in points], [(10, 10.0)])
+
+    def test_clock_stepping_back(self):
+        self.assertEqual(self.add([(1000, 1.0), (1010, 5.0)]), [(1000, 1.0)])
+        # Before the held value and at the last written time.
+        self.assertEqual(self.add([(1005, 9.0)]), [(1010, 5.0), (1005, 9.0)])
+        self.assertEqual(self.add([(1005, 20.0)]), [(1005, 20.0)])
+        self.assertEqual(self.add([(995, 30.0)]), [(995, 30.0)])
+        # The doors work again from the restarted trend.
+        self.assertEqual(self.add([(1005, 40.0), (1015, 50.0)]), [])
+
+
+class TimerWheelTest(unittest.TestCase):
+
+    def test_advance_returns_due_items(self):
+        wheel = TimerWheel(10, slots=8)
+        wheel.schedule('a', 1005)
+        wheel.schedule('b', 1025)
+        self.assertEqual(wheel.advance(1000), [])
+        self.assertEqual(wheel.advance(1010), ['a'])
+        self.assertEqual(wheel.advance(1020), [])
+        self.assertEqual(wheel.advance(1030), ['b'])
+        self.assertEqual(len(wheel), 0)
+
+    def test_reschedule_and_cancel(self):
+        wheel = TimerWheel(10, slots=8)
+        wheel.schedule('a', 1005)
+        wheel.schedule('a', 1045)
+        wheel.schedule('b', 1005)
+        wheel.cancel('b')
+        self.assertEqual(wheel.advance(1010), [])
+        self.assertEqual(wheel.advance(1050), ['a'])
+
+    def test_deadline_beyond_a_turn(self):
+        wheel = TimerWheel(10, slots=8)
+        wheel.schedule('a', 1205)
+        for t in range(1000, 1200, 10):
+            self.assertEqual(wheel.advance(t), [])
+        self.assertEqual(wheel.advance(1210), ['a'])
+
+    def test_long_step_reaches_every_slot(self):
+        wheel = TimerWheel(10, slots=8)
+        wheel.advance(1000)
+        wheel.schedule('a', 1015)
+        wheel.schedule('b', 1065)
+        self.assertEqual(sorted(wheel.advance(5000)), ['a', 'b'])
+
+
+class TopicMatcherTest(unittest.TestCase):
+
+    def test_match_whole_segments(self):
+        matcher = TopicMatcher(['/Power', '/Dc/Battery/Soc'])
+        self.assertTrue(matcher.match('N/x/grid/30/Ac/L1/Power'))
+        self.assertTrue(matcher.match('N/x/system/0/Dc/Battery/Soc'))
+        self.assertFalse(matcher.match('N/x/grid/30/Ac/L1/ReactivePower'))
+        self.assertFalse(matcher.match('N/x/system/0/Battery/Soc'))
+        self.assertFalse(matcher.match('Power'))
+        self.assertTrue(matcher.match('/Power'))
+
+    def test_get_most_specific_suffix(self):
+        matcher = TopicMatcher({'/Power': 1, '/Dc/0/Power': 2})
+        self.assertEqual(matcher.get('/Dc/0/Power'), 2)
+        self.assertEqual(matcher.get('/Dc/1/Power'), 1)
+        self.assertEqual(matcher.get('/Dc/0/Voltage', 0), 0)
+
+    def test_lookup_caches_and_evicts(self):
+        parsed = []
+        matcher = TopicMatcher(['/Power'], parse=lambda t: parsed.append(t) or t,
+                               maxsize=2)
+        self.assertEqual(matcher.lookup('a/Power'), 'a/Power')
+        self.assertEqual(matcher.lookup('a/Power'), 'a/Power')
+        self.assertIsNone(matcher.lookup('a/Voltage'))
+        self.assertEqual(parsed, ['a/Power'])
+        matcher.lookup('b/Power')
+        # a/Power was evicted and is parsed again.
+        matcher.lookup('a/Power')
+        self.assertEqual(parsed, ['a/Power', 'b/Power', 'a/Power'])
+
+
+if __name__ == '__main__':
+    unittest.main()
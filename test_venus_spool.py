@@ -0,0 +1,72 @@
+"""
+Unit tests of the disk spool.
+
+    python3 -m unittest test_venus_spool
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from venus_spool import Spool
+
+
+class SpoolTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def payloads(self, spool):
+        result = []
+        while True:
+            path = spool.oldest()
+            if path is None:
+                return result
+            result += [(ct, p, body) for offset, created, ct, p, body in spool.read(path)]
+            spool.remove(path)
+
+    def test_append_and_read_back(self):
+        spool = Spool(self.dir)
+        spool.append(b'a', 'application/json')
+        spool.append(b'b', 'text/plain', '/write?rp=30d')
+        self.assertEqual(len(spool), 2)
+        self.assertEqual(self.payloads(spool), [
+            ('application/json', '', b'a'), ('text/plain', '/write?rp=30d', b'b')])
+        self.assertEqual(len(spool), 0)
+
+    def test_reopened_spool_continues(self):
+        spool = Spool(self.dir, segment_bytes=1)
+        spool.append(b'a', 'text/plain')
+        spool.append(b'b', 'text/plain')
+        spool = Spool(self.dir, segment_bytes=1)
+        self.assertEqual(len(spool), 2)
+        spool.append(b'c', 'text/plain')
+        self.assertEqual([body for ct, p, body in self.payloads(spool)],
+                         [b'a', b'b', b'c'])
+
+    def test_size_cap_drops_oldest_segments(self):
+        spool = Spool(self.dir, max_bytes=300, segment_bytes=1)
+        for i in range(10):
+            spool.append(b'%d' % i * 50, 'text/plain')
+        self.assertLessEqual(spool.stats['bytes'], 300)
+        self.assertGreater(spool.stats['dropped'], 0)
+        bodies = [body for ct, p, body in self.payloads(spool)]
+        self.assertEqual(bodies[-1], b'9' * 50)
+        self.assertEqual(len(bodies) + spool.stats['dropped'], 10)
+
+    def test_torn_write_is_skipped(self):
+        spool = Spool(self.dir)
+        spool.append(b'a' * 100, 'text/plain')
+        spool.append(b'b' * 100, 'text/plain')
+        path = spool.oldest()
+        with open(path, 'r+b') as f:
+            f.truncate(os.path.getsize(path) - 10)
+        self.assertEqual([body for ct, p, body in self.payloads(spool)], [b'a' * 100])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,278 @@
+"""
+Building blocks of the asyncio runtime of the MQTT bridge.
+
+In this runtime the MQTT clients, the keepalive, the aligned flush, the
+uploads and the stats endpoint all run on one event loop instead of a
+thread each. paho is driven through its external loop API from socket
+callbacks, the uploads speak HTTP/1.1 over asyncio streams with a pool
+of keep-alive connections.
+"""
+
+import asyncio
+import logging
+import threading
+import time
+import urllib.parse
+
+import paho.mqtt.client as mqtt
+
+from venus_common import IngestError, IngestSender, UploadPolicy
+from venus_metrics import REGISTRY
+
+log = logging.getLogger('async')
+
+
+class MqttSocket:
+    """Drives a paho client from the event loop.
+
+    Follows the asyncio example of paho: the loop watches the socket of
+    the client and calls loop_read and loop_write when it is ready, a
+    task calls loop_misc every second for the pings.
+
+    connect() blocks until the broker answered or timed out, so it runs
+    in the default executor. The socket callbacks it triggers there are
+    passed on to the loop thread.
+    """
+
+    def __init__(self, loop, client):
+        # Created on the loop thread.
+        self._loop = loop
+        self._thread = threading.get_ident()
+        self._client = client
+        self._misc = None
+        client.on_socket_open = self.on_socket_open
+        client.on_socket_close = self.on_socket_close
+        client.on_socket_register_write = self.on_socket_register_write
+        client.on_socket_unregister_write = self.on_socket_unregister_write
+
+    def _call(self, fn, *args):
+        if threading.get_ident() == self._thread:
+            fn(*args)
+        else:
+            self._loop.call_soon_threadsafe(fn, *args)
+
+    def on_socket_open(self, client, userdata, sock):
+        self._call(self._open, client, sock)
+
+    def _open(self, client, sock):
+        self._loop.add_reader(sock, client.loop_read)
+        self._misc = self._loop.create_task(self.misc())
+
+    def on_socket_close(self, client, userdata, sock):
+        self._call(self._close, sock)
+
+    def _close(self, sock):
+        self._loop.remove_reader(sock)
+        if self._misc:
+            self._misc.cancel()
+            self._misc = None
+
+    def on_socket_register_write(self, client, userdata, sock):
+        self._call(self._loop.add_writer, sock, client.loop_write)
+
+    def on_socket_unregister_write(self, client, userdata, sock):
+        self._call(self._loop.remove_writer, sock)
+
+    async def misc(self):
+        while self._client.loop_misc() == mqtt.MQTT_ERR_SUCCESS:
+            await asyncio.sleep(1)
+
+    async def run(self, host, port, active, retry=5):
+        """Keep the client connected while active() is true."""
+        while active():
+            if self._client.socket() is None:
+                try:
+                    await self._loop.run_in_executor(
+                            None, self._client.connect, host, port, 60)
+                except Exception as e:
+                    log.error('Connecting to %s:%d failed: %s' % (host, port, e))
+            await asyncio.sleep(retry)
+
+
+class AsyncIngestSender(IngestSender):
+    """IngestSender on asyncio streams.
+
+    Same compression, stats and pooling of keep-alive connections, but
+    post() is a coroutine and a request never blocks the loop.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # Like http.client, also takes [v6 literal]:port.
+        url = urllib.parse.urlsplit('//' + self._host)
+        self._address = (url.hostname, url.port or (443 if self._ssl else 80))
+
+    async def _open(self):
+        start = time.time()
+        conn = await asyncio.open_connection(*self._address, ssl=self._ssl)
+        self.stats['connects'] += 1
+        self._ewma('handshake', time.time() - start)
+        return conn
+
+    def close(self):
+        pool, self._pool = self._pool, []
+        for reader, writer in pool:
+            writer.close()
+
+    async def post(self, body, content_type='application/json', path=None):
+        body, headers = self._prepare(body, content_type)
+        path = path or self._path
+        start = time.time()
+        conn = self._pool.pop() if self._pool else None
+        reused = conn is not None
+        try:
+            try:
+                if conn is None:
+                    conn = await asyncio.wait_for(self._open(), self._timeout)
+                status, will_close = await asyncio.wait_for(
+                        self._request(conn, path, body, headers), self._timeout)
+            except (ConnectionError, asyncio.IncompleteReadError):
+                if not reused:
+                    raise
+                # The server closed the idle connection, retry once on
+                # a fresh one.
+                conn[1].close()
+                conn = await asyncio.wait_for(self._open(), self._timeout)
+                status, will_close = await asyncio.wait_for(
+                        self._request(conn, path, body, headers), self._timeout)
+        except (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError,
+                ValueError) as e:
+            if conn is not None:
+                conn[1].close()
+            self._request_seconds.observe(time.time() - start)
+            raise IngestError('%s: %s' % (type(e).__name__, e)) from e
+        self._request_seconds.observe(time.time() - start)
+        if will_close or len(self._pool) >= self._pool_size:
+            conn[1].close()
+        else:
+            self._pool.append(conn)
+        if status >= 300:
+            raise IngestError('HTTP status %d' % status, status)
+        return status
+
+    async def _request(self, conn, path, body, headers):
+        reader, writer = conn
+        start = time.time()
+        head = ['POST %s HTTP/1.1' % path, 'Host: %s' % self._host,
+                'Content-Length: %d' % len(body)]
+        head += ['%s: %s' % h for h in headers.items()]
+        writer.write(('\r\n'.join(head) + '\r\n\r\n').encode('latin-1') + body)
+        await writer.drain()
+        line = await reader.readline()
+        if not line:
+            raise ConnectionError('Connection closed')
+        version, status = line.split(None, 2)[:2]
+        status = int(status)
+        length = None
+        chunked = False
+        will_close = version == b'HTTP/1.0'
+        while True:
+            line = await reader.readline()
+            if not line.strip():
+                break
+            name, _, value = line.decode('latin-1').partition(':')
+            name = name.strip().lower()
+            value = value.strip().lower()
+            if name == 'content-length':
+                length = int(value)
+            elif name == 'transfer-encoding':
+                chunked = value == 'chunked'
+            elif name == 'connection':
+                will_close = value == 'close'
+        if chunked:
+            while True:
+                size = int((await reader.readline()).split(b';')[0], 16)
+                await reader.readexactly(size + 2)
+                if not size:
+                    break
+        elif length is not None:
+            await reader.readexactly(length)
+        elif status not in (204, 304):
+            await reader.read()
+            will_close = True
+        self._ewma('transfer', time.time() - start)
+        return status, will_close
+
+
+class AsyncUploader:
+    """The BatchSender of the asyncio runtime.
+
+    submit() starts an upload task instead of queueing for a thread. At
+    most maxsize batches are in flight, further ones are dropped, and
+    at most `workers` chunks are uploaded at the same time. Chunking,
+    retries and spooling follow the same UploadPolicy as the
+    BatchSender, the spool is written from the default executor.
+    """
+
+    def __init__(self, sender, fmt, stats, maxsize=10, spool=None,
+                 replayer=None, chunk_size=1000, workers=2, retries=3,
+                 backoff=0.5, backoff_max=8, path_for=None):
+        self._sender = sender
+        self._format = fmt
+        self._maxsize = maxsize
+        self._stats = stats
+        self._policy = UploadPolicy(stats, spool, replayer, chunk_size,
+                                    retries, backoff, backoff_max, path_for)
+        self._tasks = set()
+        self._workers = workers
+        REGISTRY.gauge('venus_upload_queue_depth', 'Batches waiting for upload',
+                       lambda: len(self._tasks))
+
+    def start(self):
+        """Called on the running loop before the first submit."""
+        # Before Python 3.10 a Semaphore binds to the loop current at
+        # its creation, which is not the one of asyncio.run().
+        self._workers = asyncio.Semaphore(self._workers)
+
+    def submit(self, points, rp=None):
+        if len(self._tasks) >= self._maxsize:
+            self._policy.dropped(points)
+            return False
+        task = asyncio.get_running_loop().create_task(self.upload(points, rp))
+        # The loop only keeps weak references to tasks.
+        self._tasks.add(task)
+        task.add_done_callback(self._done)
+        self._stats['ingest']['pending'] = len(self._tasks)
+        return True
+
+    def _done(self, task):
+        self._tasks.discard(task)
+        self._stats['ingest']['pending'] = len(self._tasks)
+        if not task.cancelled() and task.exception():
+            log.error('Upload Exception %s' % type(task.exception()))
+
+    async def close(self):
+        if self._tasks:
+            await asyncio.wait(list(self._tasks))
+        self._sender.close()
+
+    async def upload(self, points, rp=None):
+        latency = time.time()
+        path, chunks = self._policy.split(points, rp)
+        results = await asyncio.gather(
+                *[self.upload_chunk(chunk, path) for chunk in chunks])
+        self._policy.uploaded(all(results), time.time() - latency, len(chunks))
+
+    async def upload_chunk(self, points, path=None):
+        body = self._format.serialize(points)
+        attempt = 0
+        while True:
+            start = time.time()
+            try:
+                async with self._workers:
+                    await self._sender.post(body, self._format.content_type, path=path)
+                break
+            except IngestError as e:
+                error = e
+            delay = self._policy.retry(error, attempt)
+            if delay is None:
+                if self._policy.failed(error, points):
+                    # Writes and flushes a segment file, not on the loop.
+                    await asyncio.get_running_loop().run_in_executor(
+                            None, self._policy.spool.append, body,
+                            self._format.content_type, path or '')
+                return False
+            attempt += 1
+            await asyncio.sleep(delay)
+        self._policy.chunk_uploaded(time.time() - start)
+        return True
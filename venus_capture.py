@@ -0,0 +1,119 @@
+"""
+Capture of the raw messages a bridge receives, for replay with
+venus_replay.py.
+
+A capture is an append-only file: a header followed by records of a
+fixed size header and a variable size body. A topic (or dbus service
+and path) is written once in a definition record and referenced by its
+id afterwards, so a message costs the record header and its raw
+payload. The reader memory-maps the file and does not load it.
+"""
+
+import json
+import logging
+import mmap
+import struct
+import threading
+
+from venus_common import clock
+
+log = logging.getLogger('capture')
+
+MAGIC = b'VENUSCAP'
+VERSION = 1
+# magic, version, wall clock and monotonic time at the start
+FILE_HEADER = struct.Struct('<8sHdd')
+# kind, seconds since the start, topic id, body length
+RECORD = struct.Struct('<BdII')
+
+TOPIC = 0
+MQTT = 1
+DBUS = 2
+
+
+class CaptureWriter:
+
+    def __init__(self, path, clock=clock):
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._topics = {}
+        self._start = clock.monotonic()
+        self._file = open(path, 'wb')
+        self._file.write(FILE_HEADER.pack(MAGIC, VERSION, clock.time(), self._start))
+        self.records = 0
+        log.info('Capturing messages to %s' % path)
+
+    def _topic(self, topic, t):
+        # Called with the lock held.
+        id = self._topics.get(topic)
+        if id is None:
+            id = self._topics[topic] = len(self._topics)
+            name = topic.encode()
+            self._file.write(RECORD.pack(TOPIC, t, id, len(name)) + name)
+        return id
+
+    def _append(self, kind, topic, body):
+        with self._lock:
+            if self._file.closed:
+                return
+            t = self._clock.monotonic() - self._start
+            id = self._topic(topic, t)
+            self._file.write(RECORD.pack(kind, t, id, len(body)) + body)
+            self.records += 1
+
+    def mqtt(self, topic, payload):
+        self._append(MQTT, topic, payload or b'')
+
+    def dbus(self, service, path, value, instance):
+        # dbus types are subclasses of the python ones.
+        self._append(DBUS, '%s %s' % (service, path),
+                     json.dumps([value, instance]).encode())
+
+    def flush(self):
+        with self._lock:
+            if not self._file.closed:
+                self._file.flush()
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+
+class CaptureReader:
+    """Iterates (kind, seconds since the start, topic, body) records."""
+
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, self.start_time, _ = FILE_HEADER.unpack_from(self._map)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError('%s is no capture of version %d' % (path, VERSION))
+
+    def __iter__(self):
+        buf = self._map
+        size = len(buf)
+        offset = FILE_HEADER.size
+        topics = {}
+        unpack = RECORD.unpack_from
+        while offset + RECORD.size <= size:
+            kind, t, id, length = unpack(buf, offset)
+            offset += RECORD.size
+            if offset + length > size:
+                # Torn write at the end, e.g. the bridge was killed.
+                return
+            body = buf[offset:offset + length]
+            offset += length
+            if kind == TOPIC:
+                topics[id] = body.decode()
+            else:
+                yield kind, t, topics[id], body
+
+    def close(self):
+        self._map.close()
+
+
+def dbus_call(topic, body):
+    """Return the value_changed_on_dbus arguments of a DBUS record."""
+    service, path = topic.split(' ', 1)
+    value, instance = json.loads(body)
+    return service, path, {}, {'Value': value, 'Text': str(value)}, instance
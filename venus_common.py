@@ -0,0 +1,1498 @@
+"""
+Shared helpers for the Venus GX MQTT and dbus bridges.
+"""
+
+import concurrent.futures
+from datetime import datetime
+import gzip
+import http.client
+import json
+import logging
+import math
+import os
+import queue
+import random
+import socket
+import ssl
+import sys
+import threading
+import time
+import traceback
+import zlib
+from urllib.parse import urlencode
+
+from venus_metrics import REGISTRY, SIZE_BUCKETS, message_counters
+
+log = logging.getLogger('ingest')
+
+
+class Clock:
+    """Wall clock for timestamps and monotonic clock for durations.
+
+    Formatting a timestamp is the expensive part, so the ISO string is
+    built once per wall clock second and reused.
+    """
+
+    def __init__(self):
+        self._iso = (None, None)
+
+    def time(self):
+        return time.time()
+
+    def monotonic(self):
+        return time.monotonic()
+
+    def iso(self, ts=None):
+        """Return ts (default now) as ISO 8601 UTC string."""
+        second = int(self.time() if ts is None else ts)
+        cached, iso = self._iso
+        if cached != second:
+            iso = time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(second))
+            # One tuple, so other threads never see a torn update.
+            self._iso = (second, iso)
+        return iso
+
+
+clock = Clock()
+
+
+class FlushScheduler:
+    """Fires at the end of wall clock aligned intervals.
+
+    Deadlines always sit on the interval grid (e.g. :00, :10, :20 for
+    10s) instead of being the previous firing plus the interval, so a
+    late wakeup never shifts the following ones. How late each firing
+    was is reported as jitter.
+
+    A few missed deadlines, e.g. after a short suspend, are merged into
+    one interval. Longer gaps are skipped: a forward step of the wall
+    clock (NTP at boot) would otherwise stamp the points of one interval
+    decades in the past.
+    """
+
+    def __init__(self, interval, clock=clock, stats=None, max_missed=5):
+        self.interval = interval
+        self.max_missed = max_missed
+        self._clock = clock
+        self.deadline = self.next_boundary(clock.time())
+        self.stats = stats if stats is not None else {}
+        self.stats.update({
+            'jitter': 0,
+            'jitter_avg': 0,
+            'jitter_max': 0,
+            'missed': 0,
+            'skipped': 0,
+        })
+
+    def next_boundary(self, now):
+        return now - now % self.interval + self.interval
+
+    def delay(self):
+        """Seconds until the next deadline."""
+        now = self._clock.time()
+        if self.deadline - now > self.interval:
+            # The wall clock was set back, e.g. by NTP after boot.
+            self.deadline = self.next_boundary(now)
+        return max(0, self.deadline - now)
+
+    def fire(self):
+        """Return (start, end) of the interval that just ended or None.
+
+        If up to max_missed deadlines were missed, e.g. after the system
+        was suspended, they are merged into one interval. After more, the
+        interval is the last one and the others are counted as skipped.
+        """
+        now = self._clock.time()
+        if now < self.deadline:
+            return None
+        start = self.deadline - self.interval
+        jitter = now - self.deadline
+        self.deadline = self.next_boundary(now)
+        end = self.deadline - self.interval
+        stats = self.stats
+        missed = int(round((end - start) / self.interval)) - 1
+        if missed > self.max_missed:
+            stats['skipped'] += missed
+            start = end - self.interval
+            jitter = now - end
+            missed = 0
+        stats['jitter'] = jitter
+        stats['jitter_avg'] = (jitter + 9*stats['jitter_avg'])/10
+        stats['jitter_max'] = max(stats['jitter_max'], jitter)
+        stats['missed'] += missed
+        return start, end
+
+
+try:
+    # Faster drop-in decoders, if one is installed.
+    from orjson import loads as json_loads
+except ImportError:
+    try:
+        from ujson import loads as json_loads
+    except ImportError:
+        json_loads = json.loads
+
+_LITERALS = {b'true': True, b'false': False, b'null': None}
+
+
+def decode_value(payload):
+    """Return the value of a Venus MQTT payload like b'{"value": 53.2}'.
+
+    Numbers and literals in exactly that shape are converted without a
+    JSON parser, everything else is fully decoded. Returns None for an
+    empty or malformed payload and one without a value.
+    """
+    if not payload:
+        return None
+    if payload[-1:] == b'}':
+        if payload.startswith(b'{"value": '):
+            raw = payload[10:-1]
+        elif payload.startswith(b'{"value":'):
+            raw = payload[9:-1]
+        else:
+            raw = b''
+        if raw and raw[:1] in b'-0123456789' and b',' not in raw and b'_' not in raw:
+            try:
+                return float(raw)
+            except ValueError:
+                pass
+        elif raw in _LITERALS:
+            return _LITERALS[raw]
+    try:
+        j = json_loads(payload)
+    except ValueError:
+        return None
+    if type(j) == dict:
+        return j.get('value')
+    return None
+
+
+class TopicMatcher:
+    """Match topics against a list of path suffixes like '/Dc/0/Power'.
+
+    The suffixes are compiled into a trie over the reversed path
+    segments, so a check walks at most as many segments as the longest
+    suffix instead of testing every suffix. Decisions are cached per
+    topic string together with the metadata returned by `parse`, which
+    makes a repeated topic a single dict lookup.
+
+    If suffixes is a dict, `get` returns the value of the longest
+    suffix matching a topic.
+    """
+
+    def __init__(self, suffixes, parse=None, maxsize=4096):
+        self._trie = {}
+        for suffix in suffixes:
+            node = self._trie
+            for segment in reversed(suffix.split('/')[1:]):
+                node = node.setdefault(segment, {})
+            # None can never be a path segment, use it as end marker.
+            node[None] = suffixes[suffix] if type(suffixes) == dict else True
+        self._parse = parse
+        self._maxsize = maxsize
+        self._cache = {}
+
+    def match(self, topic):
+        segments = topic.split('/')
+        node = self._trie
+        # Never consume the first segment, the suffix has to be
+        # preceded by a '/', same as topic.endswith(suffix).
+        for i in range(len(segments) - 1, 0, -1):
+            node = node.get(segments[i])
+            if node is None:
+                return False
+            if None in node:
+                return True
+        return False
+
+    def get(self, topic, default=None):
+        """Return the value of the most specific suffix of topic."""
+        segments = topic.split('/')
+        node = self._trie
+        value = default
+        for i in range(len(segments) - 1, 0, -1):
+            node = node.get(segments[i])
+            if node is None:
+                break
+            value = node.get(None, value)
+        return value
+
+    def lookup(self, topic):
+        """Return the parsed metadata for topic or None if not allowed."""
+        try:
+            return self._cache[topic]
+        except KeyError:
+            pass
+        if topic and self.match(topic):
+            result = self._parse(topic) if self._parse else True
+        else:
+            result = None
+        if len(self._cache) >= self._maxsize:
+            # Evict the oldest entry, dicts keep insertion order.
+            del self._cache[next(iter(self._cache))]
+        self._cache[topic] = result
+        return result
+
+    def allowed(self, topic):
+        return self.lookup(topic) is not None
+
+
+class Accumulator:
+    """Running aggregate of the samples of one series in an interval.
+
+    Memory is constant per series, no matter how many samples arrive.
+    Text values only track count, first and last. A series changing
+    between text and numbers restarts with the sample of the new type.
+    """
+
+    __slots__ = ('count', 'sum', 'min', 'max', 'first', 'last')
+
+    def __init__(self, value):
+        self.count = 1
+        self.first = self.last = value
+        if type(value) == str:
+            self.sum = self.min = self.max = None
+        else:
+            self.sum = self.min = self.max = value
+
+    def add(self, value):
+        """Add a sample, False if its type changed and it restarted."""
+        if self.sum is not None:
+            try:
+                self.sum += value
+            except TypeError:
+                self.__init__(value)
+                return False
+            if value < self.min:
+                self.min = value
+            elif value > self.max:
+                self.max = value
+        elif type(value) != str:
+            self.__init__(value)
+            return False
+        self.count += 1
+        self.last = value
+        return True
+
+    def merge(self, other):
+        """Fold the samples aggregated by another accumulator into this one."""
+        self.count += other.count
+        self.last = other.last
+        if self.sum is not None and other.sum is not None:
+            self.sum += other.sum
+            if other.min < self.min:
+                self.min = other.min
+            if other.max > self.max:
+                self.max = other.max
+
+    def mean(self):
+        if self.sum is None:
+            return None
+        return self.sum / self.count
+
+    def copy(self):
+        acc = Accumulator.__new__(Accumulator)
+        acc.count = self.count
+        acc.sum = self.sum
+        acc.min = self.min
+        acc.max = self.max
+        acc.first = self.first
+        acc.last = self.last
+        return acc
+
+
+class Coalescer:
+    """Per-series accumulators of the running interval.
+
+    Samples fold into the slot of their series as they arrive, so
+    memory is bounded by the number of series and not by the message
+    rate. A burst of messages only grows the counts. At most
+    max_series series are tracked per interval; samples of further
+    series are dropped and counted per series.
+    """
+
+    def __init__(self, max_series=5000):
+        self._lock = threading.Lock()
+        self._points = {}
+        self._max_series = max_series
+        self.dropped = {}
+        # Samples that changed the type of their series in an interval.
+        self.retyped = 0
+
+    def add(self, series, value):
+        with self._lock:
+            acc = self._points.get(series)
+            if acc is not None:
+                if not acc.add(value):
+                    self.retyped += 1
+                return True
+            if len(self._points) >= self._max_series:
+                self.dropped[series] = self.dropped.get(series, 0) + 1
+                return False
+            self._points[series] = Accumulator(value)
+            return True
+
+    def snapshot(self):
+        """Return the accumulators of the interval and start a new one."""
+        with self._lock:
+            points, self._points = self._points, {}
+        return points
+
+    def pop_dropped(self):
+        with self._lock:
+            dropped, self.dropped = self.dropped, {}
+        return dropped
+
+    def __len__(self):
+        return len(self._points)
+
+
+class Tier:
+    """Accumulators of one downsampling resolution."""
+
+    def __init__(self, resolution, rp):
+        self.resolution = resolution
+        self.rp = rp
+        self.start = None
+        self.points = {}
+
+    def add(self, points, start, end):
+        """Fold points of [start, end) in, return the bucket if it closed.
+
+        The closed bucket is returned as (points, bucket start), also
+        when it is empty, so the tiers above close theirs in time.
+        """
+        if self.start is None:
+            self.start = start - start % self.resolution
+        acc = self.points
+        for s, a in points.items():
+            if a.sum is None:
+                continue
+            mine = acc.get(s)
+            if mine is None:
+                acc[s] = a.copy()
+            else:
+                mine.merge(a)
+        if end < self.start + self.resolution:
+            return None
+        closed, self.points = self.points, {}
+        start, self.start = self.start, end - end % self.resolution
+        return closed, start
+
+
+class Downsampler:
+    """Cascading downsampling tiers, e.g. 10s -> 60s -> 5min -> 10min.
+
+    Every tier is fed with the buckets of the tier below as they close,
+    the first one with the accumulators of the flush interval. Sums and
+    counts are merged, so means are exact and min/max are the extremes
+    of the raw samples, not of the means of a lower tier.
+    """
+
+    def __init__(self, tiers):
+        self.tiers = [Tier(resolution, rp) for resolution, rp in tiers]
+
+    def add(self, points, start, end):
+        """Return [(rp, [(series, time, accumulator)])] of closed buckets."""
+        closed = []
+        for tier in self.tiers:
+            bucket = tier.add(points, start, end)
+            if bucket is None:
+                break
+            points, start = bucket
+            end = start + tier.resolution
+            if not points:
+                continue
+            # Stamped with the bucket start, same as a GROUP BY time().
+            closed.append((tier.rp, [(s, start, a) for s, a in points.items()]))
+        return closed
+
+
+def parse_tiers(spec, interval):
+    """Parse "60:30d,300:365d" into [(60, '30d'), (300, '365d')]."""
+    tiers = []
+    lower = interval
+    for tier in spec.split(','):
+        resolution, rp = tier.split(':', 1)
+        resolution = int(resolution)
+        if resolution <= lower or resolution % lower:
+            raise ValueError('Tier resolution %d is no multiple of %d' % (resolution, lower))
+        tiers.append((resolution, rp))
+        lower = resolution
+    return tiers
+
+
+class TimerWheel:
+    """Hashed timer wheel of deadlines with a resolution of a tick.
+
+    Scheduling and cancelling are O(1), advancing only looks at the
+    slots of the ticks that passed, not at every scheduled item.
+    Deadlines further away than a turn of the wheel stay in their slot
+    until a later turn reaches them.
+    """
+
+    def __init__(self, resolution, slots=512):
+        self._resolution = resolution
+        self._slots = [{} for _ in range(slots)]
+        self._deadlines = {}
+        self._tick = None
+
+    def _slot(self, deadline):
+        return self._slots[int(deadline // self._resolution) % len(self._slots)]
+
+    def schedule(self, item, deadline):
+        self.cancel(item)
+        self._deadlines[item] = deadline
+        self._slot(deadline)[item] = deadline
+
+    def cancel(self, item):
+        deadline = self._deadlines.pop(item, None)
+        if deadline is not None:
+            del self._slot(deadline)[item]
+
+    def advance(self, now):
+        """Remove and return the items whose deadline passed."""
+        tick = int(now // self._resolution)
+        n = len(self._slots)
+        if self._tick is None:
+            steps = n - 1
+        else:
+            # The slot of the last tick may hold deadlines later in it.
+            steps = min(tick - self._tick, n - 1)
+        self._tick = tick
+        due = []
+        for t in range(tick - steps, tick + 1):
+            slot = self._slots[t % n]
+            for item, deadline in list(slot.items()):
+                if deadline <= now:
+                    del slot[item]
+                    del self._deadlines[item]
+                    due.append(item)
+        return due
+
+    def __len__(self):
+        return len(self._deadlines)
+
+
+# Heartbeat deadlines are spread over this fraction of the TTL.
+HEARTBEAT_JITTER = 0.1
+
+
+class Trend:
+    """What was last written of a series and the swinging door state."""
+
+    __slots__ = ('absolute', 'relative', 'ttl', 'jitter', 'time', 'value',
+                 'held_time', 'held', 'slope_min', 'slope_max', 'seen',
+                 'written', 'rewrites')
+
+    def __init__(self, absolute, relative, ttl, jitter):
+        self.absolute = absolute
+        self.relative = relative
+        self.ttl = ttl
+        self.jitter = jitter
+        self.time = None
+        self.value = None
+        self.held_time = None
+        self.held = None
+        self.slope_min = None
+        self.slope_max = None
+        self.seen = 0
+        self.written = 0
+        # Heartbeat rewrites since the last received value.
+        self.rewrites = 0
+
+
+class Compressor:
+    """Decides which values of a series are worth writing.
+
+    A value is written when it deviates from the last written one by
+    more than the deadband of its series, by default any change. The
+    deadband is the larger of an absolute deviation and a fraction of
+    the last written value. With swinging_door, numeric series are
+    compressed with the swinging door trending algorithm instead: a
+    value is held back until a straight line from the last written
+    value to the next one no longer passes within the deadband of all
+    values in between, so ramps are written as their end points and
+    the held back value is written late.
+
+    Either way the last value of a series is written again once its
+    staleness TTL (the heartbeat) passed without a write, also if no
+    new value arrived, so rarely sent values do not leave gaps in
+    Grafana. The deadlines are kept in a timer wheel, one TTL after the
+    write plus up to a tenth of it by a hash of the series, which
+    spreads the rewrites of series written at the same time.
+
+    Series are rewritten until they are forgotten, when their device is
+    removed. Without such a signal max_rewrites bounds the rewrites, a
+    series that received no value for as many TTLs is forgotten, its
+    device is probably gone.
+    """
+
+    def __init__(self, deadbands=None, swinging_door=False, heartbeats=None,
+                 resolution=10, max_rewrites=None, stats=None):
+        deadbands = dict(deadbands or {})
+        self._default = deadbands.pop('*', (0, 0))
+        self._deadbands = TopicMatcher(deadbands)
+        heartbeats = dict(heartbeats or {})
+        self._default_ttl = heartbeats.pop('*', 3600)
+        self._heartbeats = TopicMatcher(heartbeats)
+        self._swinging_door = swinging_door
+        self._max_rewrites = max_rewrites
+        self._trends = {}
+        longest = max([self._default_ttl] + list(heartbeats.values()))
+        self._wheel = TimerWheel(resolution,
+                                 min(4096, int(longest * (1 + HEARTBEAT_JITTER) // resolution) + 1))
+        self.stats = stats if stats is not None else {}
+        self.stats.update({
+            'seen': 0,
+            'written': 0,
+            'ratio': 0,
+            'rewritten': 0,
+            'forgotten': 0,
+            'series': {},
+        })
+
+    def _trend(self, series):
+        topic = '/' + series.measurement.replace('.', '/')
+        ttl = self._heartbeats.get(topic, self._default_ttl)
+        trend = Trend(*self._deadbands.get(topic, self._default), ttl,
+                      zlib.crc32(series.key.encode()) / 2**32 * ttl * HEARTBEAT_JITTER)
+        self._trends[series] = trend
+        return trend
+
+    def add(self, series, time, value):
+        """Return the (series, time, value) points to write, maybe none."""
+        trend = self._trends.get(series)
+        if trend is None:
+            trend = self._trend(series)
+        trend.seen += 1
+        trend.rewrites = 0
+        points = []
+        if trend.time is None or type(value) == str or type(trend.value) == str:
+            if value != trend.value:
+                self._write(points, series, trend, time, value)
+        else:
+            deviation = max(trend.absolute, trend.relative * abs(trend.value))
+            if self._swinging_door and deviation:
+                self._door(points, series, trend, time, value, deviation)
+            elif abs(value - trend.value) > deviation:
+                self._write(points, series, trend, time, value)
+        stats = self.stats
+        stats['seen'] += 1
+        self._count(points)
+        if trend.written:
+            stats['series'][series.key] = round(trend.seen / trend.written, 2)
+        return points
+
+    def expire(self, time):
+        """Return the points of the series whose TTL passed by time.
+
+        A value held back by the swinging door is written as it is,
+        otherwise the last written value is repeated at time.
+        """
+        points = []
+        rewritten = 0
+        for series in self._wheel.advance(time):
+            trend = self._trends[series]
+            if trend.held is not None:
+                self._write(points, series, trend, trend.held_time, trend.held)
+            elif self._max_rewrites is not None and trend.rewrites >= self._max_rewrites:
+                self.forget(series)
+            else:
+                trend.rewrites += 1
+                rewritten += 1
+                self._write(points, series, trend, time, trend.value)
+        self.stats['rewritten'] += rewritten
+        self._count(points)
+        return points
+
+    def forget(self, series):
+        """Stop tracking series, e.g. when its device was removed."""
+        if self._trends.pop(series, None) is None:
+            return
+        self._wheel.cancel(series)
+        self.stats['series'].pop(series.key, None)
+        self.stats['forgotten'] += 1
+
+    def _count(self, points):
+        stats = self.stats
+        stats['written'] += len(points)
+        if stats['written']:
+            stats['ratio'] = round(stats['seen'] / stats['written'], 2)
+
+    def _door(self, points, series, trend, time, value, deviation):
+        if time <= (trend.time if trend.held is None else trend.held_time):
+            # The clock stepped back, there is no slope to this value.
+            # Write it and restart the doors from it.
+            if trend.held is not None:
+                self._write(points, series, trend, trend.held_time, trend.held)
+            self._write(points, series, trend, time, value)
+            return
+        dt = time - trend.time
+        slope = (value - trend.value) / dt
+        if trend.held is not None and not trend.slope_min <= slope <= trend.slope_max:
+            # A line to this value leaves the deadband of a value in
+            # between, write the previous one and restart the doors.
+            self._write(points, series, trend, trend.held_time, trend.held)
+            deviation = max(trend.absolute, trend.relative * abs(trend.value))
+            dt = time - trend.time
+            slope = (value - trend.value) / dt
+        # The slopes of lines from the last written value that pass
+        # within the deadband of this value, the doors only ever close.
+        slope_min = slope - deviation / dt
+        slope_max = slope + deviation / dt
+        if trend.held is not None:
+            slope_min = max(trend.slope_min, slope_min)
+            slope_max = min(trend.slope_max, slope_max)
+        trend.slope_min = slope_min
+        trend.slope_max = slope_max
+        trend.held_time = time
+        trend.held = value
+
+    def _write(self, points, series, trend, time, value):
+        points.append((series, time, value))
+        trend.time = time
+        trend.value = value
+        trend.held = None
+        trend.written += 1
+        self._wheel.schedule(series, time + trend.ttl + trend.jitter)
+
+
+def parse_heartbeats(spec):
+    """Parse "3600" or "/Dc/Battery/Soc=600,*=3600" into {suffix: ttl}."""
+    heartbeats = {}
+    for heartbeat in spec.split(','):
+        if '=' not in heartbeat:
+            heartbeat = '*=' + heartbeat
+        suffix, value = heartbeat.split('=', 1)
+        suffix = suffix.strip()
+        if suffix != '*' and not suffix.startswith('/'):
+            raise ValueError('Heartbeat topic %s does not start with /' % suffix)
+        heartbeats[suffix] = float(value)
+        if heartbeats[suffix] <= 0:
+            raise ValueError('Heartbeat of %s is not positive' % suffix)
+    return heartbeats
+
+
+def parse_deadbands(spec):
+    """Parse "/Dc/0/Power=5,/Frequency=0.1%" into {suffix: (abs, rel)}.
+
+    A value with a % sign is relative to the last written value, '*'
+    sets the deadband of all other series.
+    """
+    deadbands = {}
+    for deadband in spec.split(','):
+        suffix, value = deadband.split('=', 1)
+        suffix = suffix.strip()
+        if suffix != '*' and not suffix.startswith('/'):
+            raise ValueError('Deadband topic %s does not start with /' % suffix)
+        value = value.strip()
+        if value.endswith('%'):
+            deadbands[suffix] = (0, float(value[:-1]) / 100)
+        else:
+            deadbands[suffix] = (float(value), 0)
+    return deadbands
+
+
+class Series:
+    """One measurement of one device, identified by its tags.
+
+    Series are created by a SeriesRegistry only, which guarantees a
+    single instance per tag combination, so they can be used as dict
+    keys and compared by identity.
+    """
+
+    __slots__ = ('id', 'key', 'measurement', 'path', 'portal', 'instance',
+                 'phase', '_line_prefix')
+
+    def __init__(self, id, measurement, path, portal, instance):
+        self.id = id
+        self.measurement = measurement
+        self.path = path
+        self.portal = portal
+        self.instance = instance
+        self.key = sys.intern('.'.join((measurement, path, portal, instance)))
+        self.phase = None
+        self._line_prefix = None
+
+    def point(self, time, value):
+        """Return the ingest JSON representation of a value.
+
+        An Accumulator is written as its mean, min and max.
+        """
+        if type(value) == Accumulator:
+            fields = {'value': value.mean(), 'min': value.min, 'max': value.max}
+        else:
+            fields = {'text' if type(value) == str else 'value': value}
+        return {
+            "measurement": self.measurement,
+            "tags": {
+                "path": self.path,
+                "instanceNumber": self.instance,
+                "portalId": self.portal,
+            },
+            "time": time,
+            "fields": fields,
+        }
+
+    @property
+    def line_prefix(self):
+        """Escaped measurement and tag set for the Influx line protocol."""
+        if self._line_prefix is None:
+            tags = (
+                ('instanceNumber', self.instance),
+                ('path', self.path),
+                ('portalId', self.portal),
+            )
+            # Empty tag values are not allowed in line protocol.
+            self._line_prefix = ','.join(
+                [escape_measurement(self.measurement)] +
+                ['%s=%s' % (k, escape_tag(v)) for k, v in tags if v])
+        return self._line_prefix
+
+    def __repr__(self):
+        return 'Series(%s)' % self.key
+
+
+class PhaseGroup:
+    """The L1, L2 and L3 series of a quantity and their Lx series."""
+
+    __slots__ = ('series', 'mean', 'phases')
+
+    def __init__(self, series, mean):
+        self.series = series
+        self.mean = mean
+        self.phases = {}
+
+
+# Quantities of phased measurements which get an Lx series, and
+# whether Lx is the mean (True) or the sum (False) of the phases.
+PHASE_QUANTITIES = {
+    'Power': False,
+    'Current': False,
+    'Energy': False,
+    'I': False,
+    'P': False,
+    'Voltage': True,
+    'V': True,
+}
+
+
+class SeriesRegistry:
+    """Interns the tag strings of every series seen once.
+
+    A new phased series (e.g. Ac.L2.Power) is linked to its PhaseGroup
+    on registration, so the Lx aggregation never has to look at the
+    measurement string again.
+    """
+
+    def __init__(self):
+        self._series = {}
+        self._groups = {}
+
+    def get(self, measurement, path, portal, instance):
+        key = (measurement, path, portal, instance)
+        series = self._series.get(key)
+        if series is None:
+            series = Series(len(self._series), *map(sys.intern, key))
+            self._series[key] = series
+            self._link_phase(series)
+        return series
+
+    def _link_phase(self, series):
+        parts = series.measurement.split('.')
+        i = None
+        for phase in ('L1', 'L2', 'L3'):
+            if phase in parts:
+                i = parts.index(phase)
+        if i is None or i + 1 >= len(parts) or parts[i+1] not in PHASE_QUANTITIES:
+            return
+        lx = series.measurement.replace('L1', 'Lx').replace('L2', 'Lx').replace('L3', 'Lx')
+        key = (lx, series.path, series.portal, series.instance)
+        group = self._groups.get(key)
+        if group is None:
+            group = PhaseGroup(self.get(*key), PHASE_QUANTITIES[parts[i+1]])
+            self._groups[key] = group
+        group.phases[parts[i]] = series
+        series.phase = group
+
+    def __len__(self):
+        return len(self._series)
+
+    def __iter__(self):
+        return iter(self._series.values())
+
+
+def add_phase_totals(points):
+    """Add the Lx accumulators to a snapshot of per-series accumulators.
+
+    Lx is the sum (mean for voltages) of the interval means of the
+    phases and only added if all three phases were seen.
+    """
+    groups = set(s.phase for s in points if s.phase is not None)
+    for group in groups:
+        accs = [points.get(s) for s in group.phases.values()]
+        if len(accs) != 3 or any(a is None or a.sum is None for a in accs):
+            continue
+        value = sum(a.mean() for a in accs)
+        if group.mean:
+            value /= 3
+        points[group.series] = Accumulator(value)
+    return points
+
+
+def escape_measurement(s):
+    return s.replace(',', '\\,').replace(' ', '\\ ')
+
+
+def escape_tag(s):
+    return s.replace(',', '\\,').replace('=', '\\=').replace(' ', '\\ ')
+
+
+def escape_string(s):
+    return s.replace('\\', '\\\\').replace('"', '\\"')
+
+
+class JsonFormat:
+    """The JSON list of point dicts the ingest endpoint accepts."""
+
+    name = 'json'
+    content_type = 'application/json'
+
+    def serialize(self, points):
+        """Serialize (series, timestamp, value) tuples."""
+        iso = clock.iso
+        return json.dumps([
+            series.point(iso(ts), value) for series, ts, value in points
+        ]).encode()
+
+
+class LineFormat:
+    """Influx line protocol with integer timestamps."""
+
+    name = 'line'
+    content_type = 'text/plain; charset=utf-8'
+    PRECISION = {
+        's': 1,
+        'ms': 1000,
+        'us': 1000000,
+        'ns': 1000000000,
+    }
+
+    def __init__(self, precision='s'):
+        self.precision = precision
+        self._scale = self.PRECISION[precision]
+
+    def serialize(self, points):
+        """Serialize (series, timestamp, value) tuples."""
+        scale = self._scale
+        lines = []
+        for series, ts, value in points:
+            if type(value) == str:
+                field = 'text="%s"' % escape_string(value)
+            elif type(value) == Accumulator:
+                field = 'value=%r,min=%r,max=%r' % (
+                        float(value.mean()), float(value.min), float(value.max))
+            elif math.isfinite(value):
+                field = 'value=%r' % float(value)
+            else:
+                continue
+            lines.append('%s %s %d' % (
+                series.line_prefix, field, round(ts * scale)))
+        return '\n'.join(lines).encode()
+
+
+FORMATS = ('json', 'line')
+WRITE_APIS = ('ingest', 'v1', 'v2')
+
+
+def make_format(name, precision='s'):
+    if name == 'json':
+        return JsonFormat()
+    elif name == 'line':
+        return LineFormat(precision)
+    raise ValueError('Unknown format %s' % name)
+
+
+def write_path(api, fmt, database='victron', org=None, bucket=None, rp=None):
+    """Return the request path of the write endpoint for a write API.
+
+    rp selects a retention policy other than the default one. For v2
+    it picks the bucket mapped as "<bucket>/<rp>".
+    """
+    precision = getattr(fmt, 'precision', None)
+    if api == 'ingest':
+        params = {}
+        if precision:
+            params['precision'] = precision
+        if rp:
+            params['rp'] = rp
+        if params:
+            return '/ingest?' + urlencode(params)
+        return '/ingest'
+    if fmt.name != 'line':
+        raise ValueError('The %s write API needs the line format' % api)
+    if api == 'v1':
+        params = {'db': database, 'precision': precision}
+        if rp:
+            params['rp'] = rp
+        return '/write?' + urlencode(params)
+    elif api == 'v2':
+        bucket = bucket or database
+        if rp:
+            bucket = '%s/%s' % (bucket, rp)
+        return '/api/v2/write?' + urlencode({
+            'org': org or '', 'bucket': bucket, 'precision': precision})
+    raise ValueError('Unknown write API %s' % api)
+
+
+def auth_headers(api, token):
+    if api == 'ingest':
+        return {'Token': token}
+    return {'Authorization': 'Token %s' % token}
+
+
+class IngestError(Exception):
+    """Raised when a batch could not be delivered to the ingest host."""
+
+    def __init__(self, message, status=None):
+        super().__init__(message)
+        self.status = status
+
+    @property
+    def retryable(self):
+        # Connection problems, server errors and rate limiting are worth
+        # another try, other client errors will fail the same way again.
+        return self.status is None or self.status >= 500 or self.status == 429
+
+
+class IngestSender:
+    """Posts payloads to the ingest host over pooled keep-alive connections.
+
+    Connections are kept open between flushes, so only the first write
+    (or the first after the server closed the connection) pays for the
+    TCP and TLS handshake. The request body can be gzip or deflate
+    compressed. Handshake and transfer times are tracked separately in
+    the given stats dict.
+
+    host is "host[:port]" for HTTPS, or prefixed with http:// for plain
+    HTTP, e.g. http://influx:8086.
+    """
+
+    COMPRESSION = ('none', 'gzip', 'deflate')
+
+    def __init__(self, host, headers, path='/ingest', compress='none',
+                 pool_size=2, timeout=5, stats=None):
+        if compress not in self.COMPRESSION:
+            raise ValueError('Unknown compression %s' % compress)
+        scheme, sep, rest = host.partition('://')
+        if not sep:
+            scheme, rest = 'https', host
+        if scheme not in ('http', 'https'):
+            raise ValueError('Unknown scheme %s' % scheme)
+        self._host = rest.rstrip('/')
+        self._path = path
+        self._headers = headers
+        self._compress = compress
+        self._pool_size = pool_size
+        self._timeout = timeout
+        self._pool = []
+        self._lock = threading.Lock()
+        self._ssl = ssl.create_default_context() if scheme == 'https' else None
+        self.stats = stats if stats is not None else {}
+        for k in ('connects', 'bytes', 'bytes_raw'):
+            self.stats.setdefault(k, 0)
+        for k in ('handshake', 'transfer'):
+            self.stats.setdefault(k, 0)
+        # The averages start at their first observation.
+        self._observed = set()
+        self._request_seconds = REGISTRY.histogram(
+                'venus_ingest_request_seconds',
+                'Duration of ingest requests, including a reconnect')
+        self._payload_bytes = REGISTRY.histogram(
+                'venus_ingest_payload_bytes',
+                'Size of ingest request bodies as sent', SIZE_BUCKETS)
+
+    def _acquire(self):
+        with self._lock:
+            if self._pool:
+                return self._pool.pop()
+        if self._ssl is None:
+            return http.client.HTTPConnection(self._host, timeout=self._timeout)
+        return http.client.HTTPSConnection(
+                self._host, timeout=self._timeout, context=self._ssl)
+
+    def _release(self, conn):
+        with self._lock:
+            if len(self._pool) < self._pool_size:
+                self._pool.append(conn)
+                return
+        conn.close()
+
+    def close(self):
+        with self._lock:
+            pool, self._pool = self._pool, []
+        for conn in pool:
+            conn.close()
+
+    def _ewma(self, key, value):
+        if key not in self._observed:
+            self._observed.add(key)
+            self.stats[key] = value
+        else:
+            self.stats[key] = (value + 9*self.stats[key])/10
+
+    def _prepare(self, body, content_type):
+        """Return the compressed body and the headers of a request."""
+        headers = dict(self._headers)
+        headers['Content-Type'] = content_type
+        self.stats['bytes_raw'] += len(body)
+        if self._compress == 'gzip':
+            body = gzip.compress(body, 6)
+            headers['Content-Encoding'] = 'gzip'
+        elif self._compress == 'deflate':
+            body = zlib.compress(body, 6)
+            headers['Content-Encoding'] = 'deflate'
+        self.stats['bytes'] += len(body)
+        self._payload_bytes.observe(len(body))
+        return body, headers
+
+    def post(self, body, content_type='application/json', path=None):
+        body, headers = self._prepare(body, content_type)
+        path = path or self._path
+        start = time.time()
+        conn = self._acquire()
+        reused = conn.sock is not None
+        try:
+            try:
+                status = self._request(conn, path, body, headers)
+            except (ConnectionError, http.client.RemoteDisconnected):
+                if not reused:
+                    raise
+                # The server closed the idle connection, retry once on
+                # a fresh one.
+                conn.close()
+                status = self._request(conn, path, body, headers)
+        except (OSError, http.client.HTTPException) as e:
+            conn.close()
+            self._request_seconds.observe(time.time() - start)
+            raise IngestError('%s: %s' % (type(e).__name__, e)) from e
+        self._request_seconds.observe(time.time() - start)
+        self._release(conn)
+        if status >= 300:
+            raise IngestError('HTTP status %d' % status, status)
+        return status
+
+    def _request(self, conn, path, body, headers):
+        if conn.sock is None:
+            start = time.time()
+            conn.connect()
+            self.stats['connects'] += 1
+            self._ewma('handshake', time.time() - start)
+        start = time.time()
+        conn.request('POST', path, body=body, headers=headers)
+        response = conn.getresponse()
+        response.read()
+        self._ewma('transfer', time.time() - start)
+        if response.will_close:
+            conn.close()
+        return response.status
+
+
+class UploadPolicy:
+    """How batches are uploaded, shared by BatchSender and AsyncUploader.
+
+    Large batches are split into chunks of at most chunk_size points. A
+    failed chunk is retried with jittered exponential backoff; the
+    points carry their own timestamps, so a chunk that did arrive the
+    first time is simply overwritten. Chunks which still fail go to the
+    spool, if there is one, otherwise they are dropped. The senders only
+    do the requests, the sleeps and the spool writes in their runtime.
+    """
+
+    def __init__(self, stats, spool=None, replayer=None, chunk_size=1000,
+                 retries=3, backoff=0.5, backoff_max=8, path_for=None):
+        self.spool = spool
+        self._replayer = replayer
+        self._path_for = path_for
+        self._chunk_size = chunk_size
+        self._retries = retries
+        self._backoff = backoff
+        self._backoff_max = backoff_max
+        self._stats = stats
+        ingest = self._stats['ingest']
+        for k in ('dropped', 'pending', 'chunks', 'retries', 'chunk_latency',
+                  'chunk_latency_max'):
+            ingest.setdefault(k, 0)
+        self._chunks = {result: REGISTRY.counter(
+                'venus_ingest_chunks', 'Uploaded chunks by result', result=result)
+                for result in ('ok', 'retried', 'failed', 'spooled')}
+        self._dropped = REGISTRY.counter(
+                'venus_upload_dropped_batches', 'Batches dropped on a full upload queue')
+
+    def dropped(self, points):
+        """Count a batch dropped because the uploads cannot keep up."""
+        log.error('Upload queue full, dropping: %d' % len(points))
+        self._stats['msg']['failed'].inc(len(points))
+        self._stats['ingest']['dropped'] += 1
+        self._dropped.inc()
+
+    def split(self, points, rp=None):
+        """Return the request path of a batch and its chunks."""
+        path = None
+        if rp and self._path_for:
+            path = self._path_for(rp)
+        n = self._chunk_size
+        return path, [points[i:i+n] for i in range(0, len(points), n)]
+
+    def uploaded(self, ok, latency, chunks):
+        """Account for a batch whose chunks are all done."""
+        ingest = self._stats['ingest']
+        if ok:
+            ingest['writes'] += 1
+        if self._replayer is not None:
+            self._replayer.report(ok)
+        ingest['latency'] = (latency + 9*ingest['latency'])/10
+        log.info('Latency %dms (%d chunks)' % (latency*1000, chunks))
+
+    def retry(self, error, attempt):
+        """Return the delay before retrying a failed chunk, None to give up."""
+        if not error.retryable or attempt >= self._retries:
+            return None
+        delay = min(self._backoff_max, self._backoff * 2**attempt)
+        self._stats['ingest']['retries'] += 1
+        self._chunks['retried'].inc()
+        log.info('Write failure %s, retry %d in %.1fs' % (error, attempt + 1, delay))
+        return random.uniform(delay / 2, delay)
+
+    def failed(self, error, points):
+        """Account for a chunk given up on, return True to spool it."""
+        self._stats['ingest']['failed'] += 1
+        if self.spool is not None and error.retryable:
+            log.error('Write failure %s, spooling: %d' % (error, len(points)))
+            self._chunks['spooled'].inc()
+            return True
+        log.error('Write failure %s, dropping: %d' % (error, len(points)))
+        self._stats['msg']['failed'].inc(len(points))
+        self._chunks['failed'].inc()
+        return False
+
+    def chunk_uploaded(self, latency):
+        ingest = self._stats['ingest']
+        ingest['chunks'] += 1
+        self._chunks['ok'].inc()
+        ingest['chunk_latency'] = (latency + 9*ingest['chunk_latency'])/10
+        ingest['chunk_latency_max'] = max(ingest['chunk_latency_max'], latency)
+
+
+class BatchSender:
+    """Uploads flushed batches from a dedicated thread.
+
+    submit() never blocks, batches are handed over through a bounded
+    queue. If the uploads cannot keep up the batch is dropped and
+    counted instead of stalling the caller.
+
+    A batch can be written to another retention policy than the default
+    one, path_for maps the retention policy to the request path.
+
+    The chunks of a batch (see UploadPolicy) are uploaded by up to
+    `workers` threads in parallel.
+    """
+
+    def __init__(self, sender, fmt, stats, maxsize=10, spool=None,
+                 replayer=None, chunk_size=1000, workers=2, retries=3,
+                 backoff=0.5, backoff_max=8, path_for=None):
+        self._sender = sender
+        self._format = fmt
+        self._stats = stats
+        self._policy = UploadPolicy(stats, spool, replayer, chunk_size,
+                                    retries, backoff, backoff_max, path_for)
+        self._executor = None
+        if workers > 1:
+            self._executor = concurrent.futures.ThreadPoolExecutor(
+                    max_workers=workers)
+        self._queue = queue.Queue(maxsize=maxsize)
+        REGISTRY.gauge('venus_upload_queue_depth', 'Batches waiting for upload',
+                       self._queue.qsize)
+        self._thread = threading.Thread(target=self.run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def submit(self, points, rp=None):
+        try:
+            self._queue.put_nowait((points, rp))
+        except queue.Full:
+            self._policy.dropped(points)
+            return False
+        self._stats['ingest']['pending'] = self._queue.qsize()
+        return True
+
+    def close(self):
+        self._queue.put(None)
+        self._thread.join()
+        if self._executor:
+            self._executor.shutdown()
+
+    def run(self):
+        while True:
+            batch = self._queue.get()
+            self._stats['ingest']['pending'] = self._queue.qsize()
+            if batch is None:
+                break
+            try:
+                self.upload(*batch)
+            except Exception as e:
+                log.error('Upload Exception %s' % type(e))
+                traceback.print_exc()
+
+    def upload(self, points, rp=None):
+        latency = time.time()
+        path, chunks = self._policy.split(points, rp)
+        if self._executor and len(chunks) > 1:
+            results = list(self._executor.map(
+                lambda chunk: self.upload_chunk(chunk, path), chunks))
+        else:
+            results = [self.upload_chunk(chunk, path) for chunk in chunks]
+        self._policy.uploaded(all(results), time.time() - latency, len(chunks))
+
+    def upload_chunk(self, points, path=None):
+        body = self._format.serialize(points)
+        attempt = 0
+        while True:
+            start = time.time()
+            try:
+                self._sender.post(body, self._format.content_type, path=path)
+                break
+            except IngestError as e:
+                error = e
+            delay = self._policy.retry(error, attempt)
+            if delay is None:
+                if self._policy.failed(error, points):
+                    self._policy.spool.append(body, self._format.content_type, path or '')
+                return False
+            attempt += 1
+            time.sleep(delay)
+        self._policy.chunk_uploaded(time.time() - start)
+        return True
+
+
+def add_pipeline_args(parser):
+    """Add the options of the IngestBridge to an argparse parser."""
+    parser.add_argument('--dryrun', action='store_true',
+                        help='do not publish values')
+    parser.add_argument('--ingest_host', help='Ingestion host[:port] to connect to over HTTPS, '
+                        'prefix with http:// for plain HTTP, e.g. http://influx:8086', default='127.0.0.1')
+    parser.add_argument('--compress', help='Compression of the ingest request body',
+                        choices=IngestSender.COMPRESSION, default='none')
+    parser.add_argument('--pool_size', help='Ingest connections kept open', type=int, default=2)
+    parser.add_argument('--format', help='Wire format of the written points',
+                        choices=FORMATS, default='json')
+    parser.add_argument('--precision', help='Timestamp precision of the line format',
+                        choices=LineFormat.PRECISION, default='s')
+    parser.add_argument('--write_api', help='Endpoint to write to: the ingest proxy or InfluxDB v1/v2',
+                        choices=WRITE_APIS, default='ingest')
+    parser.add_argument('--database', help='InfluxDB v1 database (v2: default bucket)', default='victron')
+    parser.add_argument('--org', help='InfluxDB v2 organization')
+    parser.add_argument('--bucket', help='InfluxDB v2 bucket')
+    parser.add_argument('--max_series', help='Maximum series aggregated per interval', type=int, default=5000)
+    parser.add_argument('--tiers', help='Downsampling tiers written to their own retention policy, '
+                        'e.g. 60:30d,300:365d,600:inf (resolution in seconds:retention policy)')
+    parser.add_argument('--deadband', help='Deviation from the last written value below which a value '
+                        'is not written, e.g. /Dc/0/Power=5,/Frequency=0.1%%,*=0 (default: any change)')
+    parser.add_argument('--swinging_door', action='store_true',
+                        help='compress numeric series with the swinging door algorithm within their deadband')
+    parser.add_argument('--heartbeat', help='Seconds after which the last value of a series is written again, '
+                        'e.g. 3600 or /Dc/Battery/Soc=600,*=3600', default='3600')
+    parser.add_argument('--chunk_size', help='Maximum points per ingest request', type=int, default=1000)
+    parser.add_argument('--upload_workers', help='Chunks uploaded in parallel', type=int, default=2)
+    parser.add_argument('--retries', help='Retries of a failed chunk', type=int, default=3)
+    parser.add_argument('--spool_dir', help='Directory to keep failed writes in for replay, e.g. on /data')
+    parser.add_argument('--spool_max_mb', help='Maximum size of the spool in MB', type=int, default=50)
+    parser.add_argument('--spool_max_age', help='Maximum age of spooled writes in hours', type=int, default=168)
+    parser.add_argument('--replay_rate', help='Spooled writes replayed per second', type=float, default=2)
+    parser.add_argument('--capture', help='Record all received messages to this file for venus_replay.py')
+    parser.add_argument('--token', help='Token to authorize ingestion', default=os.getenv('TOKEN', socket.gethostname()))
+
+
+def pipeline_options(parser, args, interval):
+    """Check the options of add_pipeline_args, return the IngestBridge keyword arguments."""
+    tiers = None
+    if args.tiers:
+        try:
+            tiers = parse_tiers(args.tiers, interval)
+        except ValueError as e:
+            parser.error('--tiers: %s' % e)
+    try:
+        heartbeats = parse_heartbeats(args.heartbeat)
+    except ValueError as e:
+        parser.error('--heartbeat: %s' % e)
+    deadbands = None
+    if args.deadband:
+        try:
+            deadbands = parse_deadbands(args.deadband)
+        except ValueError as e:
+            parser.error('--deadband: %s' % e)
+    if args.write_api != 'ingest' and args.format != 'line':
+        parser.error('--write_api %s needs --format line' % args.write_api)
+    if args.dryrun:
+        log.warning('Running in dryrun mode')
+    return dict(ingest_host=args.ingest_host, token=args.token,
+                dryrun=args.dryrun,
+                compress=args.compress, pool_size=args.pool_size,
+                wire_format=args.format, precision=args.precision,
+                write_api=args.write_api, database=args.database,
+                org=args.org, bucket=args.bucket, spool_dir=args.spool_dir,
+                spool_max_mb=args.spool_max_mb,
+                spool_max_age=args.spool_max_age,
+                replay_rate=args.replay_rate, chunk_size=args.chunk_size,
+                upload_workers=args.upload_workers, retries=args.retries,
+                max_series=args.max_series, tiers=tiers,
+                deadbands=deadbands, swinging_door=args.swinging_door,
+                heartbeats=heartbeats, capture=args.capture)
+
+
+class IngestBridge:
+    """What the bridges do with the samples they receive.
+
+    The samples are coalesced per series and flushed at the aligned
+    interval boundaries, compressed, downsampled and uploaded, failed
+    uploads are spooled. The bridges subclass it, add the receiving
+    side and call write() at the end of every interval.
+
+    The uploads run on a BatchSender with the IngestSender unless other
+    classes are given, the spool is always replayed through the
+    IngestSender from a thread.
+    """
+
+    def __init__(self, interval, ingest_host='127.0.0.1', token='unset',
+                 dryrun=False, stats_port=None, compress='none', pool_size=2,
+                 wire_format='json', precision='s', write_api='ingest',
+                 database='victron', org=None, bucket=None, spool_dir=None,
+                 spool_max_mb=50, spool_max_age=168, replay_rate=2,
+                 chunk_size=1000, upload_workers=2, retries=3,
+                 max_series=5000, tiers=None, deadbands=None,
+                 swinging_door=False, heartbeats=None, max_rewrites=None,
+                 capture=None, sender_class=None, uploader_class=BatchSender):
+        # These import this module.
+        from venus_capture import CaptureWriter
+        from venus_spool import Spool, SpoolReplayer
+
+        self._points = Coalescer(max_series=max_series)
+        self._series = SeriesRegistry()
+        self._stats = {
+                'msg': message_counters(),
+                'ingest': {
+                    'latency': 0,
+                    'writes': 0,
+                    'failed': 0,
+                    },
+                'report': datetime.utcnow()
+        }
+        self._dryrun = dryrun
+        self._clock = clock
+        self._stats['scheduler'] = {}
+        self._scheduler = FlushScheduler(interval, self._clock,
+                                         self._stats['scheduler'])
+        self._stats_port = stats_port
+        self._httpd = None
+
+        self._format = make_format(wire_format, precision)
+        sender_args = dict(path=write_path(write_api, self._format, database,
+                                           org, bucket),
+                           compress=compress, pool_size=pool_size,
+                           stats=self._stats['ingest'])
+        headers = auth_headers(write_api, token)
+        self._sender = IngestSender(ingest_host, headers, **sender_args)
+        self._spool = None
+        replayer = None
+        if spool_dir:
+            self._stats['spool'] = {}
+            self._spool = Spool(spool_dir, max_bytes=spool_max_mb*1024*1024,
+                                max_age=spool_max_age*3600,
+                                stats=self._stats['spool'])
+            replayer = SpoolReplayer(self._spool, self._sender, rate=replay_rate)
+        sender = self._sender
+        if sender_class is not None:
+            sender = sender_class(ingest_host, headers, **sender_args)
+        self._uploader = uploader_class(
+                sender, self._format, self._stats, spool=self._spool,
+                replayer=replayer, chunk_size=chunk_size,
+                workers=upload_workers, retries=retries,
+                path_for=lambda rp: write_path(
+                    write_api, self._format, database, org, bucket, rp))
+        self._tiers = Downsampler(tiers) if tiers else None
+        self._stats['compression'] = {}
+        self._compressor = Compressor(deadbands, swinging_door=swinging_door,
+                                      heartbeats=heartbeats, resolution=interval,
+                                      max_rewrites=max_rewrites,
+                                      stats=self._stats['compression'])
+        REGISTRY.gauge('venus_accumulated_series',
+                       'Series aggregated in the running interval',
+                       lambda: len(self._points))
+        REGISTRY.gauge('venus_series', 'Series seen since the start',
+                       lambda: len(self._series))
+        REGISTRY.gauge('venus_retyped_samples',
+                       'Samples that switched their series between text and numbers',
+                       lambda: self._points.retyped)
+        REGISTRY.gauge('venus_flush_jitter_seconds', 'Lateness of the last flush',
+                       lambda: self._stats['scheduler']['jitter'])
+        if self._spool:
+            REGISTRY.gauge('venus_spool_depth', 'Payloads waiting in the spool',
+                           lambda: len(self._spool))
+        self._flush_seconds = REGISTRY.histogram(
+                'venus_flush_seconds', 'Duration of the flush of an interval')
+        self._capture = CaptureWriter(capture) if capture else None
+
+    def log_dropped(self):
+        dropped = self._points.pop_dropped()
+        if dropped:
+            worst = sorted(dropped.items(), key=lambda d: -d[1])[:5]
+            log.error('Too many series, dropped samples of %d series: %s' % (
+                len(dropped), ', '.join('%s=%d' % (s.key, n) for s, n in worst)))
+
+    def write(self, start, end):
+        """Flush the interval [start, end), return its accumulators."""
+        flush_start = time.monotonic()
+        points = add_phase_totals(self._points.snapshot())
+        self.log_dropped()
+        compressor = self._compressor
+
+        # Stamp with the middle of the interval the values are the mean of.
+        dt = (start + end) / 2
+        tbw = []
+        duped = 0
+        unchanged = 0
+        for s, acc in points.items():
+            # Everything is aggregated to a mean value
+            if acc.sum is not None:
+                value = acc.mean()
+            else:
+                # Don't need to do anything, just take the first value
+                # TODO(jdi): Should be mode probably.
+                value = acc.first
+            duped += acc.count - 1
+            written = compressor.add(s, dt, value)
+            if written:
+                tbw.extend(written)
+            else:
+                unchanged += 1
+        # Repeat the last value of series not written for their TTL.
+        stale = compressor.expire(dt)
+        tbw.extend(stale)
+        if tbw:
+            log.info('Write %d points (across %d unique measurements), Deduped %d, Unchanged %d, Stale %d, Jitter %.3fs' % (
+                len(tbw), len(points), duped, unchanged, len(stale), self._scheduler.stats['jitter']))
+            if not self._dryrun:
+                self._uploader.submit(tbw)
+            else:
+                log.debug('  Skip write due to dryrun.')
+        if self._tiers:
+            for rp, tier_points in self._tiers.add(points, start, end):
+                log.info('Write %d points to %s' % (len(tier_points), rp))
+                if not self._dryrun:
+                    self._uploader.submit(tier_points, rp)
+        log.info('Messages handled: %s' % (self._stats['msg']))
+        if self._capture:
+            self._capture.flush()
+        self._flush_seconds.observe(time.monotonic() - flush_start)
+        return points
@@ -3,19 +3,12 @@ Module to read Venus GX messages from the dbus
 and write them to a server to process.
 """
 
-from datetime import datetime, timedelta
-import json
 import logging
 import os
-import queue
-import requests
-import socket
+import resource
 import sys
-import threading
 import traceback
 import time
-from collections import defaultdict
-from http.server import HTTPServer, BaseHTTPRequestHandler
 
 import dbus
 
@@ -24,39 +17,16 @@ try:
 except ImportError:
   from gi.repository import GLib as gobject
 
-sys.path.insert(
-    1,
-    os.path.join(
-        os.path.dirname(__file__),
-        "/opt/victronenergy/dbus-systemcalc-py/ext/velib_python",
-    ),
-)
-# from vedbus import VeDbusService
-import dbusmonitor
-from vedbus import VeDbusItemImport
-
+from venus_common import (
+    IngestBridge, TopicMatcher, add_pipeline_args, pipeline_options)
+from venus_metrics import serve_stats
 
 INTERVAL=30
+STALL_CHECK=1
 
 log = logging.getLogger('dbus_to_influx')
 
 
-class Stats(BaseHTTPRequestHandler):
-
-    def do_GET(self):
-        self.send_response(200)
-        self.send_header('Content-type', 'application/json')
-        self.end_headers()
-        if hasattr(self.server, 'data'):
-            self.wfile.write(json.dumps(self.server.data).encode())
-        else:
-            self.wfile.write(json.dumps({"error": "No data defined"}))
-
-    def log_message(self, format, *args):
-        log.info("%s - %s" % (
-            self.address_string(), format%args))
-
-
 TOPICS = (
         '/Ac/Energy/Forward',
         '/Ac/Energy/Reverse',
@@ -114,299 +84,351 @@ TOPICS = (
 )
 
 
-class AllDbusMonitor(dbusmonitor.DbusMonitor):
-
-  def service_wanted(self, serviceName):
-    print('service_wanted', serviceName)
-    return True
-
-
-class DbusToIngest:
-   def write_points(self, tbw):
-     requests.post(self._url, json=tbw, headers={'Token': self._token}, timeout=5)
-
+PATHS = frozenset(TOPICS)
+BUSITEM = 'com.victronenergy.BusItem'
+# Services without device values, the settings have thousands of items.
+SKIP_SERVICES = ('com.victronenergy.settings',)
+
+
+def unwrap(v):
+    """Convert a dbus value to the python type, invalid ([]) to None."""
+    if isinstance(v, dbus.Array):
+        return [unwrap(x) for x in v] if len(v) else None
+    if isinstance(v, dbus.Double):
+        return float(v)
+    if isinstance(v, dbus.Boolean):
+        return bool(v)
+    if isinstance(v, (dbus.Byte, dbus.Int16, dbus.UInt16, dbus.Int32,
+                      dbus.UInt32, dbus.Int64, dbus.UInt64)):
+        return int(v)
+    if isinstance(v, (dbus.String, dbus.ObjectPath, dbus.Signature)):
+        return str(v)
+    return v
+
+
+class ServiceMonitor:
+    """Watches the values of TOPICS of all com.victronenergy services.
+
+    Replaces the velib DbusMonitor, which introspects and reads every
+    path of every service one synchronous call at a time before the main
+    loop runs. Here the changes of all services arrive through a single
+    PropertiesChanged match rule. The initial values of a service come
+    from one asynchronous GetItems call, or a GetValue of / on services
+    too old to have GetItems. Services are loaded as the replies arrive,
+    ones appearing later as their name shows up on the bus.
+
+    Services sending the changes of many paths at once in an
+    ItemsChanged signal are handled a batch per signal.
+    callback(service, instance, [(path, value), ...]) is called with
+    the initial values of a service and with the changes of each signal,
+    for the paths in TOPICS.
+    """
+
+    def __init__(self, bus, callback, device_added=None, device_removed=None,
+                 stats=None):
+        self._bus = bus
+        self._callback = callback
+        self._device_added = device_added
+        self._device_removed = device_removed
+        # Unique bus name to service name, and service to instance.
+        self._owners = {}
+        self._instances = {}
+        self._start = None
+        self.stats = stats if stats is not None else {}
+        self.stats.update({
+            'services': 0,
+            'items': 0,
+            'calls': 0,
+            'failed': 0,
+            'pending': 0,
+            'unknown_sender': 0,
+            'signals': 0,
+            'changes': 0,
+            'startup': None,
+            'startup_rss_mb': None,
+        })
+
+    def start(self):
+        """Subscribe to the signals and request the initial values."""
+        self._start = time.monotonic()
+        self._bus.add_signal_receiver(
+                self.properties_changed, dbus_interface=BUSITEM,
+                signal_name='PropertiesChanged', path_keyword='path',
+                sender_keyword='sender')
+        self._bus.add_signal_receiver(
+                self.items_changed, dbus_interface=BUSITEM,
+                signal_name='ItemsChanged', path='/', sender_keyword='sender')
+        self._bus.add_signal_receiver(
+                self.name_owner_changed, signal_name='NameOwnerChanged',
+                dbus_interface='org.freedesktop.DBus')
+        names = [str(n) for n in self._bus.list_names()]
+        for name in names:
+            if self.wanted(name):
+                self.load(name)
+        if not self.stats['pending']:
+            self.loaded()
+
+    def wanted(self, service):
+        return (service.startswith('com.victronenergy.')
+                and not service.startswith(SKIP_SERVICES))
+
+    def _call(self, service, path, method, signature, args, reply, error):
+        self.stats['calls'] += 1
+        self.stats['pending'] += 1
+        self._bus.call_async(service, path, method[0], method[1], signature,
+                             args, reply_handler=reply, error_handler=error,
+                             timeout=10)
+
+    def load(self, service):
+        """Resolve the owner of service and fetch all its items."""
+        def owner(unique):
+            self._owners[str(unique)] = service
+            self._done()
+
+        def items(result):
+            self._add(service, dict((str(k), v['Value']) for k, v in result.items()))
+            self._done()
+
+        def values(result):
+            # GetValue of / returns the values by path relative to it.
+            self._add(service, dict(('/' + str(k), v) for k, v in result.items()))
+            self._done()
+
+        def failed(e):
+            self.stats['failed'] += 1
+            log.error('Loading %s failed: %s' % (service, e))
+            self._done()
+
+        def no_items(e):
+            if e.get_dbus_name() != 'org.freedesktop.DBus.Error.UnknownMethod':
+                return failed(e)
+            self._call(service, '/', (BUSITEM, 'GetValue'), '', [],
+                       values, failed)
+            self._done()
+
+        self._call('org.freedesktop.DBus', '/org/freedesktop/DBus',
+                   ('org.freedesktop.DBus', 'GetNameOwner'), 's', [service],
+                   owner, failed)
+        self._call(service, '/', (BUSITEM, 'GetItems'), '', [], items,
+                   no_items)
+
+    def _done(self):
+        self.stats['pending'] -= 1
+        if not self.stats['pending'] and self.stats['startup'] is None:
+            self.loaded()
+
+    def loaded(self):
+        stats = self.stats
+        stats['startup'] = time.monotonic() - self._start
+        stats['startup_rss_mb'] = round(
+                resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+        log.info('Loaded %d items of %d services in %.2fs with %d calls, peak RSS %.1fMB' % (
+            stats['items'], stats['services'], stats['startup'],
+            stats['calls'], stats['startup_rss_mb']))
+
+    def _add(self, service, values):
+        instance = unwrap(values.get('/DeviceInstance'))
+        instance = instance if type(instance) == int else 0
+        self._instances[service] = instance
+        self.stats['services'] += 1
+        if self._device_added:
+            self._device_added(service, instance)
+        items = []
+        for path, value in values.items():
+            if path in PATHS:
+                value = unwrap(value)
+                if value is not None:
+                    items.append((path, value))
+        self.stats['items'] += len(items)
+        if items:
+            self._callback(service, instance, items)
+
+    def properties_changed(self, changes, path=None, sender=None):
+        # Sent per path by services that do not batch their changes.
+        if path in PATHS and 'Value' in changes:
+            self._changed(sender, {str(path): changes})
+
+    def items_changed(self, items, sender=None):
+        self._changed(sender, items)
+
+    def _changed(self, sender, items):
+        self.stats['signals'] += 1
+        service = self._owners.get(sender)
+        if service is None:
+            # A service not loaded (yet), or one we do not watch.
+            self.stats['unknown_sender'] += 1
+            return
+        changed = []
+        for path, changes in items.items():
+            if path in PATHS:
+                value = unwrap(changes.get('Value'))
+                if value is not None:
+                    changed.append((str(path), value))
+        if changed:
+            self.stats['changes'] += len(changed)
+            self._callback(service, self._instances.get(service, 0), changed)
+
+    def name_owner_changed(self, name, old, new):
+        name = str(name)
+        if not self.wanted(name):
+            return
+        if old:
+            self._owners.pop(str(old), None)
+            instance = self._instances.pop(name, None)
+            if self._device_removed and instance is not None:
+                self._device_removed(name, instance)
+        if new:
+            self.load(name)
+
+
+class DbusToIngest(IngestBridge):
    def allowed(self, topic):
-     return (
-        topic and any(
-        topic.endswith(t) for t in TOPICS
-     ))
+     return self._topics.allowed(topic)
+
+   def parse_path(self, path):
+     return path[1:].replace("/", ".")
 
    def value_changed_on_dbus(self, dbusServiceName, dbusPath, dict, changes, deviceInstance):
-      self._stats['msg']['count'] += 1
-      p = dbusServiceName.split('.')
-      strInstance = p[2] 
-      path = '.'.join(p[0:3])
-
-      m = str(dbusPath) 
-      a = self.allowed(m)
-      if not a:
-        self._stats['msg']['ignored'] += 1
-        return
-
-      m = m[1:].replace("/", ".")
-      v = changes['Value']
-      log.debug('%s %s %s %s %s' % (path, deviceInstance, m, type(v), v))
-
-      point = {
-        "measurement": m,
-        "tags": {
-            "path": path,
-            "instanceNumber": str(deviceInstance),
-            "portalId": self._portal_id,
-        },
-        "time": datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ'),
-        "fields": {
-            # value
-            # text
-        }
-      }
-      if type(v) in (float, int):
-        v = float(v)  # automatic conversion sometimes makes it an int
-        point['fields']['value'] = v
-      elif type(v) == str:
-        point['fields']['text'] = v
-      try:
-        self._points.put(point, block=False)
-      except queue.Full:
-        log.error('Queue full, overload? - dropping all')
-        self._stats['msg']['dropped'] += self._points.qsize()
-
-   def device_added(self, a, b):
-      print('device added', a, b)
-      pass
-
-   def device_removed(self, a, b):
-      print('device removed', a, b)        
-      pass
+      self.values_changed_on_dbus(dbusServiceName, deviceInstance,
+                                  [(str(dbusPath), changes['Value'])])
+
+   def parse_series(self, service, instance, path):
+      m = self._topics.lookup(path)
+      if m is None:
+        return None
+      # com.victronenergy.battery.ttyO1 is logged as com.victronenergy.battery
+      short = '.'.join(service.split('.')[0:3])
+      return self._series.get(m, short, self._portal_id, str(instance))
+
+   def values_changed_on_dbus(self, service, instance, items):
+      """Add the (path, value) items of one service that changed at once."""
+      msg = self._stats['msg']
+      msg['count'].inc(len(items))
+      if self._capture:
+        for path, v in items:
+          self._capture.dbus(service, path, v, instance)
+      # The series of the paths of a service are only parsed once.
+      cache = self._parsed.get((service, instance))
+      if cache is None:
+        cache = self._parsed[(service, instance)] = {}
+      add = self._points.add
+      ignored = dropped = 0
+      for path, v in items:
+        try:
+          series = cache[path]
+        except KeyError:
+          series = cache[path] = self.parse_series(service, instance, path)
+        t = type(v)
+        if series is None:
+          ignored += 1
+          continue
+        if t is int:
+          v = float(v)  # automatic conversion sometimes makes it an int
+        elif t is not float and t is not str:
+          ignored += 1
+          continue
+        if not add(series, v):
+          dropped += 1
+      if ignored:
+        msg['ignored'].inc(ignored)
+      if dropped:
+        msg['dropped'].inc(dropped)
+      accepted = len(items) - ignored - dropped
+      if accepted:
+        msg['accepted'].inc(accepted)
+
+   def device_added(self, service, instance):
+      log.info('Device added %s(%s)' % (service, instance))
+
+   def device_removed(self, service, instance):
+      log.info('Device removed %s(%s)' % (service, instance))
+      # Its last values are not rewritten by the heartbeat anymore.
+      for series in self._parsed.pop((service, instance), {}).values():
+        if series is not None:
+          self._compressor.forget(series)
      
-   def __init__(self, portal_id, ingest_host='127.0.0.1',
-                token='unset', dryrun=False, stats_port=None):
+   def __init__(self, portal_id, **options):
+    super().__init__(INTERVAL, **options)
     self._portal_id = portal_id
-    self._points = queue.Queue(maxsize=10000)
-    self._msg_seen = set()
-    self._stats = {
-            'msg': {
-                'count': 0,
-                'ignored': 0,
-                'dropped': 0,
-                'failed': 0,
-                },
-            'ingest': {
-                'latency': 0,
-                'writes': 0,
-                'failed': 0,
-                },
-            'report': datetime.utcnow()
-    }
-    self._dryrun = dryrun
-    self._keepalive = set()
+    self._topics = TopicMatcher(TOPICS, parse=self.parse_path)
+    # (service, instance): {path: series or None}
+    self._parsed = {}
+    self._stats['mainloop'] = {
+            'stall': 0,
+            'stall_max': 0,
+            'flush': 0,
+            'flush_max': 0,
+            }
     self._active = True
 
-    self._httpd = None
-    if stats_port:
-        server_address = ('', stats_port)
-        self._httpd = HTTPServer(server_address, Stats)
-        self._httpd.data = self._stats
-        t = threading.Thread(target=self._httpd.serve_forever)
-        t.daemon = True
-        t.start()
-
-    self._url = 'https://%s/ingest' % ingest_host
-    self._token = token
-
-    dummy = {'code': None, 'whenToLog': 'onIntervalAlways', 'accessLevel': None}
-    monitor_target='com.victronenergy.battery'
-    monitorlist = {                                        
-                        monitor_target: {                                                    
-                            '/Dc/0/Temperature': dummy,          
-                        },                                      
-                  }                                                              
-    self._v = {}                                                    
-    self._dm = AllDbusMonitor({},                                            
-           self.value_changed_on_dbus,                     
-           deviceAddedCallback=self.device_added,                                        
-           deviceRemovedCallback=self.device_removed)
-
-    serviceNames = self._dm.dbusConn.list_names()
-    serviceNames = set(['.'.join(s.split('.')[0:3]) for s in serviceNames if s.startswith('com.victronenergy.')])
-    self.monitorlist = {}
-    for s in serviceNames:
-      self.monitorlist[s] = dict([(t, dummy) for t in TOPICS])
-    self._dm = AllDbusMonitor(self.monitorlist,                                            
-           self.value_changed_on_dbus,                     
-           deviceAddedCallback=self.device_added,
-           deviceRemovedCallback=self.device_removed)
-
-    for service_name, instance in self._dm.get_service_list().items():
-        short_name = '.'.join(service_name.split('.')[:3])
-        if short_name not in self.monitorlist:
-            continue
-        for k in self.monitorlist[short_name]:
-            value = self._dm.get_value(service_name, k, None)
-            if value is not None:
-                log.info('Initial value for %s(%s) %s: %s', service_name, instance, k, value)
-                changes = {'Value': value, 'Text': str(value)}
-                self.value_changed_on_dbus(service_name, k, {}, changes, instance)
-    
-    self.timer = datetime.utcnow()
+   def start(self):
+    """Subscribe to the dbus services and arm the timers of the main loop."""
+    if self._stats_port:
+        self._httpd = serve_stats(self._stats_port, self._stats)
+
+    # Like velib, the session bus is used where there is one, e.g. in
+    # a development setup.
+    if 'DBUS_SESSION_BUS_ADDRESS' in os.environ:
+        bus = dbus.SessionBus()
+    else:
+        bus = dbus.SystemBus()
+    self._stats['discovery'] = {}
+    self._monitor = ServiceMonitor(bus,
+           self.values_changed_on_dbus,
+           device_added=self.device_added,
+           device_removed=self.device_removed,
+           stats=self._stats['discovery'])
+    # Returns before the initial values are in, they are loaded by the
+    # main loop.
+    self._monitor.start()
+
+    self._tick = time.monotonic()
     log.info("Startup finished")
-    gobject.timeout_add(INTERVAL*1000, self.safe_write)
+    self.schedule_write()
+    gobject.timeout_add(int(STALL_CHECK*1000), self.check_stall)
 
    def quit(self):
        self._active = False
        if self._httpd:
            self._httpd.shutdown()
+       if self._capture:
+           self._capture.close()
 
-   def on_message(self, client, userdata, msg):
-    self._stats['msg']['count'] += 1
-
-    if type(v) in [float, int, bool] and self.allowed(t):
-        v = float(v)
-    elif type(v) in [str] and self.allowed(t):
-        pass
-    else:
-        self._stats['msg']['ignored'] += 1
-        if type(v) == type(None):
-            pass
-        elif t not in self._msg_seen:
-            log.info('Ignoring %s of type %s' % (t, type(v)))
-            self._msg_seen.add(t)
-        else:
-            log.debug('Ignoring %s of type %s' % (t, type(v)))
-        return
-    # print(m, v)
-    point = {
-        "measurement": m,
-        "tags": {
-            "path": p[2],
-            "instanceNumber": p[3] if len(p) > 3 else "",
-            "portalId": p[1]
-        },
-        "time": datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ'),
-        "fields": {
-            # value
-            # text
-        }
-    }
-    if type(v) == float:
-        v = float(v)  # automatic conversion sometimes makes it an int
-        point['fields']['value'] = v
-    elif type(v) == str:
-        point['fields']['text'] = v
-
-    try:
-        self._points.put(point, block=False)
-    except queue.Full:
-        log.error('Queue full, overload? - dropping all')
-        self._stats['msg']['dropped'] += self._points.qsize()
-        self._points.clear()
+   def schedule_write(self):
+       # One shot timers, re-armed for the next aligned deadline, so
+       # the flush does not drift like a periodic GLib timer.
+       gobject.timeout_add(int(self._scheduler.delay()*1000) + 1, self.safe_write)
 
    def safe_write(self):
        try:
-           self.write()
+           closed = self._scheduler.fire()
+           if closed is not None:
+               self.write(*closed)
        except Exception as e:
            log.error('Write Exception %s' % type(e))
            traceback.print_exc()
 #       self.quit()
-       return True
-
-   def write(self):
-      deduped = 0
-      unchanged = 0
-      points = defaultdict(list)
-      agg = defaultdict(dict)
-      changed = dict()
-      timer = datetime.utcnow()
-      interval = timer - self.timer
-      self.timer = timer
-      self.unchanged_timer = timer + timedelta(hours=1)
-      while True:
-        try:
-            p = self._points.get(timeout=1)
-            k = p['measurement'] + '.' + p['tags']['path'] + '.' + p['tags']['portalId'] + '.' + p['tags']['instanceNumber']
-            parts = p['measurement'].split('.')
-            i = None
-            if 'L1' in parts:
-                i = parts.index('L1')
-            if 'L2' in parts:
-                i = parts.index('L2')
-            if 'L3' in parts:
-                i = parts.index('L3')
-            if i is not None:
-                what = parts[i+1]
-                ks = k.replace('L1', 'Lx').replace('L2', 'Lx').replace('L3', 'Lx')
-                # print(ks, what)
-                if what in ('Power', 'Current', 'Voltage', 'Energy', 'I', 'P', 'V'):
-                    agg[ks][parts[i]] = p
-                #else:
-                #    print('ignored', what, ks)
-                if len(agg[ks]) == 3:
-                    ps = p.copy()
-                    ps['measurement'] = ps['measurement'].replace('L1', 'Lx').replace('L2', 'Lx').replace('L3', 'Lx')
-                    ps['fields']['value'] = sum(v['fields']['value'] for v in agg[ks].values())
-                    if what == 'Voltage' or what == 'V':
-                        ps['fields']['value'] /= 3
-                    # print('new sum', ks, what, ps['fields']['value'])
-                    points[ks].append(ps)
-                    del agg[ks]
-
-                
-            points[k].append(p)
-        except queue.Empty:
-            break
-
-      if True:
-
-        if True:
-            # this is slightly wrong and should be corrected by INTERVAL/2
-            # also it would be nice to run this on a full 10s interval
-            dt = timer.strftime('%Y-%m-%dT%H:%M:%SZ')
-            if points:
-                tbw = []
-                duped = 0
-                unchanged = 0
-                for k, ms in points.items():
-                    # These are sampled on every datapoint
-                    #if '.Power.' in k or 'Dc.0.Current' in k or 'Dc.0.Voltage' in k:
-                    #   tbw += ms
-                    #    continue
-                    # Everything else is aggregated to a mean value
-                    if ms[0]['fields'].get('value', None) is not None:
-                        value = sum(v['fields']['value'] for v in ms) / len(ms)
-                        ms[0]['fields']['value'] = value
-                    elif ms[0]['fields'].get('text', None) is not None:
-                        # Don't need to do anything, just take the first value
-                        # TODO(jdi): Should be mode probably.
-                        value = ms[0]['fields'].get('text', None)
-                        pass
-                    else:
-                        value = None
-                    duped += len(ms) - 1
-                    ms[0]['time'] = dt
-                    if k in changed and changed[k] == value:
-                      unchanged += 1
-                    else:
-                      tbw.append(ms[0])
-                      changed[k] = value
-                log.info('Write %d points (across %d unique measurements), Deduped %d, Unchanged %d, Interval %.3fs' % (
-                    len(tbw), len(points), duped, unchanged, interval.total_seconds()))
-                # print(points.keys())
-                if not self._dryrun:
-                    latency = time.time()
-                    try:
-                        self.write_points(tbw)
-                        self._stats['ingest']['writes'] += 1
-                    except requests.exceptions.RequestException as e:
-                        log.error('Write failure %s, dropping: %d' % (type(e), len(tbw)))
-                        self._stats['msg']['failed'] += len(tbw)
-                        self._stats['ingest']['failed'] += 1
-                    latency = time.time() - latency
-                    self._stats['ingest']['latency'] = (latency + 9*self._stats['ingest']['latency'])/10
-                    log.info('Latency %dms' % (latency*1000))
-                else:
-                    log.debug('  Skip write due to dryrun.')
-                points = defaultdict(list)
-            log.info('Messages handled: %s' % (self._stats['msg']))
+       self.schedule_write()
+       return False
+
+   def check_stall(self):
+      # Any delay of this timer is time the main loop was busy.
+      now = time.monotonic()
+      stall = max(0, now - self._tick - STALL_CHECK)
+      self._tick = now
+      mainloop = self._stats['mainloop']
+      mainloop['stall'] = stall
+      mainloop['stall_max'] = max(mainloop['stall_max'], stall)
+      return True
+
+   def write(self, start, end):
+      # Runs on the main loop, only snapshots the accumulators and hands
+      # the batch to the upload thread.
+      flush_start = time.monotonic()
+      super().write(start, end)
+      mainloop = self._stats['mainloop']
+      mainloop['flush'] = time.monotonic() - flush_start
+      mainloop['flush_max'] = max(mainloop['flush_max'], mainloop['flush'])
 
 def main():
     root = logging.getLogger()
@@ -423,24 +445,19 @@ def main():
     import argparse
     parser = argparse.ArgumentParser(
             description='Bridge MQTT messages from Venus GX to a compatible HTTP server with some smart sampling..')
-    parser.add_argument('--dryrun', action='store_true',
-                        help='do not publish values')
+    add_pipeline_args(parser)
     parser.add_argument('--portal_id', help='Venus Portal ID for logging')
-    parser.add_argument('--ingest_host', help='Ingestion host to connect to', default='127.0.0.1')
     parser.add_argument('--port', help='Status report port', default=8071)
-    parser.add_argument('--token', help='Token to authorize ingestion', default=os.getenv('TOKEN', socket.gethostname()))
 
     args = parser.parse_args()
-    if args.dryrun:
-        log.warning('Running in dryrun mode')
+    options = pipeline_options(parser, args, INTERVAL)
 
     from dbus.mainloop.glib import DBusGMainLoop
     # Have a mainloop, so we can send/receive asynchronous calls to and from dbus
     DBusGMainLoop(set_as_default=True)
 
-    DbusToIngest(portal_id=args.portal_id, ingest_host=args.ingest_host,
-                 token=args.token,
-                 dryrun=args.dryrun, stats_port=int(args.port))
+    DbusToIngest(portal_id=args.portal_id, stats_port=int(args.port),
+                 **options).start()
 
     logging.info('Connected to dbus, and switching over to gobject.MainLoop() (= event based)')
     mainloop = gobject.MainLoop()
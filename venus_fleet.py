@@ -0,0 +1,203 @@
+"""
+Fleet mode: bridge the MQTT brokers of many GX devices from one host.
+
+The brokers are sharded by a hash of their portal ID across worker
+processes. Every worker runs the MQTT clients of its shard on a single
+selector loop and feeds one bridge pipeline, so the points of all its
+portals are aggregated and uploaded together over one connection pool.
+The workers report their stats to the parent process, which serves
+them consolidated per portal.
+"""
+
+import concurrent.futures
+import json
+import logging
+import multiprocessing
+import queue
+import selectors
+import time
+import zlib
+
+from venus_metrics import json_default, serve_stats
+
+log = logging.getLogger('fleet')
+
+
+def parse_broker(spec, default_port=1883):
+    """Parse "host[:port] [portal_id]" into (host, port, portal_id)."""
+    parts = spec.split()
+    host, _, port = parts[0].partition(':')
+    return host, int(port or default_port), parts[1] if len(parts) > 1 else None
+
+
+def read_fleet(path):
+    """Read the brokers of a fleet file, one per line, # comments."""
+    brokers = []
+    with open(path) as f:
+        for line in f:
+            line = line.split('#', 1)[0].strip()
+            if line:
+                brokers.append(parse_broker(line))
+    return brokers
+
+
+def broker_name(broker):
+    host, port, portal = broker
+    return portal or '%s:%d' % (host, port)
+
+
+def shard(brokers, workers):
+    """Distribute the brokers over the workers by a hash of the portal."""
+    shards = [[] for _ in range(workers)]
+    for broker in brokers:
+        shards[zlib.crc32(broker_name(broker).encode()) % workers].append(broker)
+    return shards
+
+
+class BrokerLoop:
+    """Runs many paho clients on one thread.
+
+    Uses the external loop API of paho: the sockets of all clients are
+    watched by a single selector, loop_read and loop_write are only
+    called for ready sockets and loop_misc once a second for the pings.
+    Disconnected clients are reconnected after retry seconds.
+
+    connect() blocks until the broker answered or timed out, which takes
+    seconds for an unreachable GX on a cellular link. It runs on a pool
+    of connector threads, the loop does not touch a client until its
+    connect returned.
+    """
+
+    def __init__(self, clients, retry=5, connectors=4):
+        # (client, host, port)
+        self._clients = clients
+        self._retry = retry
+        self._selector = selectors.DefaultSelector()
+        self._sockets = {}
+        self._reconnect = {}
+        self._connector = concurrent.futures.ThreadPoolExecutor(
+                connectors, thread_name_prefix='connect')
+        # Client: future of its running connect.
+        self._connecting = {}
+
+    def _connect(self, client, host, port):
+        self._connecting[client] = self._connector.submit(
+                client.connect, host, port, 60)
+
+    def _connected(self):
+        """Hand the clients whose connect returned back to the loop."""
+        for client, future in list(self._connecting.items()):
+            if not future.done():
+                continue
+            del self._connecting[client]
+            e = future.exception()
+            if e is not None:
+                host, port = client.host, client.port
+                log.error('Connecting to %s:%d failed: %s' % (host, port, e))
+                self._reconnect[client] = time.monotonic() + self._retry
+
+    def _register(self, client):
+        sock = client.socket()
+        old = self._sockets.get(client)
+        if old is not None and old is not sock:
+            try:
+                self._selector.unregister(old)
+            except (KeyError, ValueError):
+                pass
+            old = None
+        self._sockets[client] = sock
+        if sock is None:
+            return
+        events = selectors.EVENT_READ
+        if client.want_write():
+            events |= selectors.EVENT_WRITE
+        if old is None:
+            self._selector.register(sock, events, client)
+        elif self._selector.get_key(sock).events != events:
+            self._selector.modify(sock, events, client)
+
+    def run(self, active):
+        for client, host, port in self._clients:
+            self._connect(client, host, port)
+        misc = 0
+        while active():
+            self._connected()
+            for client, _, _ in self._clients:
+                if client not in self._connecting:
+                    self._register(client)
+            timeout = 0.1 if self._connecting else 1
+            for key, mask in self._selector.select(timeout=timeout):
+                client = key.data
+                if mask & selectors.EVENT_READ:
+                    client.loop_read()
+                if mask & selectors.EVENT_WRITE:
+                    client.loop_write()
+            now = time.monotonic()
+            if now - misc < 1:
+                continue
+            misc = now
+            for client, host, port in self._clients:
+                if client in self._connecting:
+                    continue
+                if client.socket() is not None:
+                    client.loop_misc()
+                elif now >= self._reconnect.get(client, 0):
+                    self._connect(client, host, port)
+        self._connector.shutdown(wait=False)
+
+
+def worker(index, brokers, kwargs, reports, metrics_port):
+    from venus_mqtt_influx import MqttToIngest
+    kwargs = dict(kwargs)
+    for key in ('spool_dir', 'capture'):
+        # Every worker needs its own.
+        if kwargs.get(key):
+            kwargs[key] = '%s.%d' % (kwargs[key], index)
+    bridge = MqttToIngest(brokers=brokers, stats_port=metrics_port, **kwargs)
+
+    def report(stats):
+        try:
+            # Plain data only, the counters do not pickle.
+            stats = json.loads(json.dumps(stats, default=json_default))
+            reports.put_nowait((index, stats))
+        except queue.Full:
+            pass
+
+    bridge.on_flush = report
+    bridge.run()
+
+
+def run_fleet(brokers, workers, stats_port, kwargs):
+    """Run the shards in worker processes until interrupted.
+
+    The consolidated stats are served on stats_port, the metrics of the
+    workers on the following ports.
+    """
+    shards = [s for s in shard(brokers, workers) if s]
+    reports = multiprocessing.Queue(maxsize=100)
+    data = {'workers': {}, 'portals': {}}
+    serve_stats(stats_port, data)
+
+    def start(i):
+        p = multiprocessing.Process(
+                target=worker, name='fleet-%d' % i,
+                args=(i, shards[i], kwargs, reports, stats_port + 1 + i))
+        p.daemon = True
+        p.start()
+        log.info('Started worker %d with %d brokers: %s' % (
+            i, len(shards[i]), ', '.join(broker_name(b) for b in shards[i])))
+        return p
+
+    processes = [start(i) for i in range(len(shards))]
+    while True:
+        try:
+            index, stats = reports.get(timeout=10)
+        except queue.Empty:
+            pass
+        else:
+            data['workers'][index] = stats
+            data['portals'].update(stats.pop('portals', {}))
+        for i, p in enumerate(processes):
+            if not p.is_alive():
+                log.error('Worker %d exited with %s, restarting' % (i, p.exitcode))
+                processes[i] = start(i)
@@ -0,0 +1,256 @@
+"""
+Metrics of the bridges in the OpenMetrics text format for Prometheus.
+
+Counters and histograms are updated from the MQTT, main loop and upload
+threads. Every thread increments its own cell, so the hot path takes no
+lock; the cells are only summed up when the metrics are scraped.
+"""
+
+import asyncio
+import bisect
+import json
+import logging
+import threading
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+log = logging.getLogger('metrics')
+
+CONTENT_TYPE = 'application/openmetrics-text; version=1.0.0; charset=utf-8'
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576)
+
+
+class PerThread:
+    """Base of metrics which keep a list of numbers per updating thread."""
+
+    def __init__(self):
+        self._local = threading.local()
+        self._cells = []
+        self._lock = threading.Lock()
+
+    def _cell(self, size):
+        # Only taken the first time a thread updates the metric.
+        cell = [0] * size
+        with self._lock:
+            self._cells.append(cell)
+        self._local.cell = cell
+        return cell
+
+
+class Counter(PerThread):
+    """Monotonic counter with a cell per incrementing thread."""
+
+    def inc(self, n=1):
+        try:
+            self._local.cell[0] += n
+        except AttributeError:
+            self._cell(1)[0] += n
+
+    def value(self):
+        return sum(cell[0] for cell in list(self._cells))
+
+    def __repr__(self):
+        return str(self.value())
+
+
+class Histogram(PerThread):
+    """Counts of observations per bucket, with their sum."""
+
+    def __init__(self, buckets):
+        super().__init__()
+        self.buckets = tuple(buckets)
+
+    def observe(self, value):
+        try:
+            cell = self._local.cell
+        except AttributeError:
+            # One count per bucket, +Inf and the sum.
+            cell = self._cell(len(self.buckets) + 2)
+        cell[bisect.bisect_left(self.buckets, value)] += 1
+        cell[-1] += value
+
+    def value(self):
+        """Return the cumulative bucket counts, the count and the sum."""
+        total = [0] * (len(self.buckets) + 2)
+        for cell in list(self._cells):
+            for i, v in enumerate(cell):
+                total[i] += v
+        cumulative = []
+        count = 0
+        for v in total[:-1]:
+            count += v
+            cumulative.append(count)
+        return cumulative, count, total[-1]
+
+
+class Gauge:
+    """Reads its value from a callback when scraped."""
+
+    def __init__(self, fn):
+        self._fn = fn
+
+    def value(self):
+        return self._fn()
+
+
+class Registry:
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._families = {}
+
+    def _metric(self, kind, name, help, labels, factory, replace=False):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            family = self._families.setdefault(name, (kind, help, {}))
+            if family[0] != kind:
+                raise ValueError('Metric %s is a %s' % (name, family[0]))
+            metric = family[2].get(key)
+            if metric is None or replace:
+                metric = family[2][key] = factory()
+        return metric
+
+    def counter(self, name, help, **labels):
+        return self._metric('counter', name, help, labels, Counter)
+
+    def histogram(self, name, help, buckets=LATENCY_BUCKETS, **labels):
+        return self._metric('histogram', name, help, labels,
+                            lambda: Histogram(buckets))
+
+    def gauge(self, name, help, fn, **labels):
+        return self._metric('gauge', name, help, labels,
+                            lambda: Gauge(fn), replace=True)
+
+    def render(self):
+        with self._lock:
+            families = [(name, kind, help, list(metrics.items()))
+                        for name, (kind, help, metrics)
+                        in sorted(self._families.items())]
+        lines = []
+        for name, kind, help, metrics in families:
+            lines.append('# TYPE %s %s' % (name, kind))
+            lines.append('# HELP %s %s' % (name, help))
+            for labels, metric in metrics:
+                if kind == 'counter':
+                    lines.append('%s_total%s %s' % (
+                        name, format_labels(labels), metric.value()))
+                elif kind == 'gauge':
+                    try:
+                        value = metric.value()
+                    except Exception as e:
+                        log.debug('Gauge %s failed: %s' % (name, e))
+                        continue
+                    lines.append('%s%s %s' % (name, format_labels(labels), value))
+                else:
+                    cumulative, count, total = metric.value()
+                    bounds = [repr(float(b)) for b in metric.buckets] + ['+Inf']
+                    for le, n in zip(bounds, cumulative):
+                        lines.append('%s_bucket%s %d' % (
+                            name, format_labels(labels + (('le', le),)), n))
+                    lines.append('%s_count%s %d' % (name, format_labels(labels), count))
+                    lines.append('%s_sum%s %s' % (name, format_labels(labels), total))
+        lines.append('# EOF\n')
+        return '\n'.join(lines)
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (
+        k, str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+        for k, v in labels)
+
+
+REGISTRY = Registry()
+
+
+def json_default(o):
+    if isinstance(o, datetime):
+        return o.isoformat()
+    if isinstance(o, PerThread):
+        return o.value()
+    raise TypeError('%s is not JSON serializable' % type(o).__name__)
+
+
+def dump(data):
+    # The stats are updated by other threads while they are dumped.
+    for _ in range(3):
+        try:
+            return json.dumps(data, default=json_default)
+        except RuntimeError:
+            continue
+    return json.dumps({"error": "Stats changed while reading"})
+
+
+def stats_response(path, data, registry):
+    """Return the content type and body of a GET of path."""
+    if path.split('?')[0] == '/metrics':
+        return CONTENT_TYPE, registry.render().encode()
+    return 'application/json', dump(data).encode()
+
+
+class StatsHandler(BaseHTTPRequestHandler):
+    """/metrics in the OpenMetrics format, the stats dict as JSON otherwise."""
+
+    def do_GET(self):
+        content_type, body = stats_response(
+                self.path, self.server.data, self.server.registry)
+        self.send_response(200)
+        self.send_header('Content-type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # Scraped every few seconds, not worth an info line.
+        log.debug("%s - %s" % (self.address_string(), format%args))
+
+
+def serve_stats(port, data, registry=REGISTRY):
+    """Serve the stats and metrics on port from a daemon thread."""
+    httpd = ThreadingHTTPServer(('', port), StatsHandler)
+    httpd.daemon_threads = True
+    httpd.data = data
+    httpd.registry = registry
+    t = threading.Thread(target=httpd.serve_forever)
+    t.daemon = True
+    t.start()
+    return httpd
+
+
+async def serve_stats_async(port, data, registry=REGISTRY):
+    """Serve the stats and metrics on port from the running event loop."""
+
+    async def handle(reader, writer):
+        try:
+            request = await asyncio.wait_for(reader.readline(), 10)
+            while (await asyncio.wait_for(reader.readline(), 10)).strip():
+                pass
+            parts = request.decode('latin-1').split()
+            if len(parts) < 2 or parts[0] != 'GET':
+                writer.write(b'HTTP/1.1 405 Method Not Allowed\r\nContent-Length: 0\r\n\r\n')
+            else:
+                content_type, body = stats_response(parts[1], data, registry)
+                writer.write(('HTTP/1.1 200 OK\r\nContent-type: %s\r\n'
+                              'Content-Length: %d\r\nConnection: close\r\n\r\n' % (
+                                  content_type, len(body))).encode() + body)
+            await writer.drain()
+        except (OSError, asyncio.TimeoutError) as e:
+            log.debug('Stats request failed: %s' % e)
+        finally:
+            writer.close()
+
+    return await asyncio.start_server(handle, port=port)
+
+
+def message_counters(registry=REGISTRY):
+    """The counters of the 'msg' stats of a bridge."""
+    msg = {key: registry.counter('venus_messages', 'Messages by pipeline stage',
+                                 stage=stage)
+           for key, stage in (('count', 'received'), ('ignored', 'ignored'),
+                              ('dropped', 'dropped'), ('accepted', 'accepted'))}
+    msg['failed'] = registry.counter('venus_failed_points',
+                                     'Points which could not be written')
+    return msg
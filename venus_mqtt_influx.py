@@ -4,41 +4,33 @@ and write them to a server to process.
 """
 
 import paho.mqtt.client as mqtt
-from datetime import datetime, timedelta
+import asyncio
 import json
 import logging
 import os
-import queue
-import requests
-import socket
 import sys
 import threading
 import traceback
 import time
-from collections import defaultdict
-from http.server import HTTPServer, BaseHTTPRequestHandler
+
+from venus_common import (
+    IngestBridge, TimerWheel, TopicMatcher, add_pipeline_args, decode_value,
+    pipeline_options)
+from venus_async import AsyncIngestSender, AsyncUploader, MqttSocket
+from venus_fleet import BrokerLoop, broker_name, read_fleet, run_fleet
+from venus_metrics import serve_stats, serve_stats_async
 
 INTERVAL=10
+KEEPALIVE=30
+RUNTIMES = ('threads', 'asyncio')
+# Deepest dbus path subscribed to, Ac/Consumption/L1/Power has 4 levels.
+PATH_DEPTH=5
+# Keeps the GX publishing without republishing all its values.
+KEEPALIVE_PAYLOAD = json.dumps({'keepalive-options': ['suppress-republish']})
 
 log = logging.getLogger('mqtt_to_ingest')
 
 
-class Stats(BaseHTTPRequestHandler):
-
-    def do_GET(self):
-        self.send_response(200)
-        self.send_header('Content-type', 'application/json')
-        self.end_headers()
-        if hasattr(self.server, 'data'):
-            self.wfile.write(json.dumps(self.server.data).encode())
-        else:
-            self.wfile.write(json.dumps({"error": "No data defined"}))
-
-    def log_message(self, format, *args):
-        log.info("%s - %s" % (
-            self.address_string(), format%args))
-
-
 TOPICS = (
         '/Current',
         '/CustomName',
@@ -83,39 +75,184 @@ TOPICS = (
 )
 
 
-class MqttToIngest:
-   def write_points(self, tbw):
-     requests.post(self._url, json=tbw, headers={'Token': self._token}, timeout=5)
-
+def topic_filters(portal, suffixes=TOPICS, depth=PATH_DEPTH):
+    """Return the MQTT filters of the paths of portal ending in a suffix.
+
+    The topics are N/<portal>/<service>/<instance>/<path>. A filter
+    matches a fixed number of levels, so there is one per path depth.
+    Paths deeper than depth levels are not subscribed to. Suffixes
+    ending in a shorter one, like /Dc/0/Power in /Power, are left out,
+    their topics would otherwise be delivered once per filter.
+    """
+    filters = []
+    levels = [suffix.split('/') for suffix in suffixes]
+    for suffix, parts in zip(suffixes, levels):
+        if any(len(other) < len(parts) and parts[-len(other)+1:] == other[1:]
+               for other in levels):
+            continue
+        for extra in range(depth - suffix.count('/') + 1):
+            filters.append('N/%s/+/+/%s%s' % (portal, '+/' * extra, suffix[1:]))
+    return filters
+
+
+class Refresher:
+    """Reads the series that were not received for a while.
+
+    The GX only publishes a path when its value changes. Instead of
+    reconnecting to make it republish everything, series not received
+    for `after` seconds are requested with an R/ read of their topic, at
+    most `rate` reads per second. A series whose reads stay unanswered
+    `attempts` times is given up until it is received again, its device
+    is probably gone, and passed to on_abandon.
+    """
+
+    def __init__(self, after=3600, rate=5, attempts=3, resolution=INTERVAL,
+                 on_abandon=None, stats=None):
+        self._after = after
+        self._on_abandon = on_abandon
+        self._rate = rate
+        self._attempts = attempts
+        self._topics = {}
+        self._wheel = TimerWheel(resolution)
+        # Stale series waiting for their read, oldest first.
+        self._pending = {}
+        # Unanswered reads per series.
+        self._unanswered = {}
+        self._budget = 0
+        self._last = None
+        self._reads = 0
+        self.stats = stats if stats is not None else {}
+        for k in ('tracked', 'pending', 'reads', 'answered', 'abandoned',
+                  'republish_avoided', 'messages_avoided'):
+            self.stats.setdefault(k, 0)
+
+    def track(self, series, topic):
+        self._topics[series] = topic
+        self.stats['tracked'] = len(self._topics)
+
+    def seen(self, series, now):
+        """Note the series received in the interval ending at now."""
+        deadline = now + self._after
+        for s in series:
+            if s not in self._topics:
+                continue
+            self._wheel.schedule(s, deadline)
+            if self._unanswered.pop(s, None) is not None:
+                self.stats['answered'] += 1
+            self._pending.pop(s, None)
+
+    def refresh(self, now, client_for):
+        """Publish the reads due at now, client_for(portal) sends them."""
+        for s in self._wheel.advance(now):
+            self._pending[s] = None
+        if self._last is not None:
+            # Never save up more than an interval of reads.
+            self._budget = min(self._budget + self._rate * (now - self._last),
+                               self._rate * INTERVAL)
+        self._last = now
+        while self._pending and self._budget >= 1:
+            s = next(iter(self._pending))
+            del self._pending[s]
+            topic = self._topics[s]
+            client = client_for(topic.split('/', 2)[1])
+            if client is None:
+                # Not connected, try again later.
+                self._wheel.schedule(s, now + self._after)
+                continue
+            n = self._unanswered.get(s, 0)
+            if n >= self._attempts:
+                # Not read again until it is received again.
+                del self._unanswered[s]
+                self.stats['abandoned'] += 1
+                if self._on_abandon:
+                    self._on_abandon(s)
+                continue
+            client.publish('R' + topic[1:])
+            self._unanswered[s] = n + 1
+            self._wheel.schedule(s, now + self._after)
+            self._budget -= 1
+            self._reads += 1
+            self.stats['reads'] += 1
+        self.stats['pending'] = len(self._pending)
+
+    def count_republish(self):
+        """Account for the full republish the reads replace."""
+        self.stats['republish_avoided'] += 1
+        # A republish would have sent every tracked series.
+        self.stats['messages_avoided'] += max(0, len(self._topics) - self._reads)
+        self._reads = 0
+
+
+class MqttToIngest(IngestBridge):
    def allowed(self, topic):
-     return (
-        topic and any(
-        topic.endswith(t) for t in TOPICS
-     ))
-
-     
-   def __init__(self, mqtt_host='127.0.0.1', ingest_host='127.0.0.1',
-                token='unset', dryrun=False, stats_port=None):
-    self._points = queue.Queue(maxsize=1000)
+     return self._topics.allowed(topic)
+
+   def parse_topic(self, topic):
+     p = topic.split('/')
+     series = self._series.get('.'.join(p[4:]), p[2], p[1], p[3] if len(p) > 3 else "")
+     if self._refresher:
+         self._refresher.track(series, topic)
+     return series
+
+   def __init__(self, mqtt_host='127.0.0.1', brokers=None,
+                runtime='threads', refresh_after=3600, refresh_rate=5,
+                max_series=5000, **options):
+    if runtime not in RUNTIMES:
+        raise ValueError('Unknown runtime %s' % runtime)
+    self._runtime = runtime
+    if runtime == 'asyncio':
+        options.update(sender_class=AsyncIngestSender,
+                       uploader_class=AsyncUploader)
+    # The refresher forgets the series of vanished devices, without it
+    # their rewrites are bounded.
+    super().__init__(INTERVAL, max_series=max_series,
+                     max_rewrites=None if refresh_after else 24, **options)
+    # Rejected topics are cached too, there are many more of them than
+    # accepted series.
+    self._topics = TopicMatcher(TOPICS, parse=self.parse_topic,
+                                maxsize=max(4096, 4*max_series))
     self._msg_seen = set()
-    self._stats = {
-            'msg': {
-                'count': 0,
-                'ignored': 0,
-                'dropped': 0,
-                'failed': 0,
-                },
-            'ingest': {
-                'latency': 0,
-                'writes': 0,
-                'failed': 0,
-                },
-            'report': datetime.utcnow()
-    }
-    self._dryrun = dryrun
-    self._keepalive = set()
+    self._refresher = None
+    if refresh_after:
+        self._stats['refresh'] = {}
+        self._refresher = Refresher(
+                refresh_after, refresh_rate,
+                on_abandon=lambda series: self._compressor.forget(series),
+                stats=self._stats['refresh'])
+    self._wakeup = threading.Event()
+    self._keepalive = {}
     self._active = True
-
+    # The event loop of the asyncio runtime, quit() sets _done.
+    self._loop = None
+    self._done = None
+
+    # Called with the stats after every flush.
+    self.on_flush = None
+    # Every broker has its own client, its portal stats are the userdata.
+    self._brokers = brokers or [(mqtt_host, 1883, None)]
+    self._stats['portals'] = {}
+    self._clients = []
+    for broker in self._brokers:
+        portal = self._stats['portals'][broker_name(broker)] = {
+                'host': '%s:%d' % broker[:2],
+                'connected': False,
+                'connects': 0,
+                'msg': 0,
+                'subscriptions': 0,
+                }
+        client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION1, userdata=portal)
+        client.on_connect = self.on_connect
+        client.on_disconnect = self.on_disconnect
+        client.on_message = self.on_message
+        client.on_subscribe = self.on_subscribe
+        self._clients.append((client, broker[0], broker[1]))
+    self._mqtt = self._clients[0][0]
+
+   def run(self):
+    """Connect to the broker and bridge until quit() is called."""
+    if self._runtime == 'asyncio':
+        asyncio.run(self.run_async())
+        return
     t = threading.Thread(target=self.safe_keepalive)
     t.daemon = True
     t.start()
@@ -124,27 +261,14 @@ class MqttToIngest:
     t.daemon = True
     t.start()
 
-    self._httpd = None
-    if stats_port:
-        server_address = ('', stats_port)
-        self._httpd = HTTPServer(server_address, Stats)
-        self._httpd.data = self._stats
-        t = threading.Thread(target=self._httpd.serve_forever)
-        t.daemon = True
-        t.start()
-
-    self._url = 'https://%s/ingest' % ingest_host
-    self._token = token
-
-    self._mqtt = mqtt.Client(mqtt.CallbackAPIVersion.VERSION1)
-    self._mqtt.on_connect = self.on_connect
-    self._mqtt.on_disconnect = self.on_disconnect
-    self._mqtt.on_message = self.on_message
-    self._mqtt.on_subscribe = self.on_subscribe
+    if self._stats_port:
+        self._httpd = serve_stats(self._stats_port, self._stats)
 
+    if len(self._clients) > 1:
+        BrokerLoop(self._clients).run(lambda: self._active)
     while self._active:
         try:
-            self._mqtt.connect(mqtt_host, 1883, 60)
+            self._mqtt.connect(self._clients[0][1], self._clients[0][2], 60)
             self._mqtt.loop_forever()
         except Exception as e:
             log.error('MQTT Exception: %s' % type(e))
@@ -153,48 +277,102 @@ class MqttToIngest:
 
     self.quit()
 
+   async def run_async(self):
+    """run() of the asyncio runtime, everything on one event loop."""
+    self._loop = asyncio.get_running_loop()
+    self._done = asyncio.Event()
+    self._uploader.start()
+    server = None
+    if self._stats_port:
+        server = await serve_stats_async(self._stats_port, self._stats)
+    tasks = [self._loop.create_task(self.safe_async(self.keepalive_async())),
+             self._loop.create_task(self.safe_async(self.write_loop_async()))]
+    for client, host, port in self._clients:
+        tasks.append(self._loop.create_task(MqttSocket(self._loop, client).run(
+            host, port, lambda: self._active)))
+    try:
+        await self._done.wait()
+    finally:
+        self._active = False
+        for task in tasks:
+            task.cancel()
+        for client, _, _ in self._clients:
+            client.disconnect()
+        if server:
+            server.close()
+        await self._uploader.close()
+        if self._capture:
+            self._capture.close()
+
+   async def safe_async(self, coro):
+       try:
+           await coro
+       except Exception as e:
+           log.error('%s Exception %s' % (coro.__name__, type(e)))
+           traceback.print_exc()
+       self.quit()
+
    def quit(self):
        self._active = False
+       self._wakeup.set()
+       if self._done is not None:
+           # May be called from another thread.
+           self._loop.call_soon_threadsafe(self._done.set)
+           return
        if self._httpd:
            self._httpd.shutdown()
-       self._mqtt.disconnect()
+       for client, _, _ in self._clients:
+           client.disconnect()
+       if self._capture:
+           self._capture.close()
 
    def on_connect(self, client, userdata, flags, rc):
-    log.info('Connected to mqtt')
-    client.subscribe('N/#')
+    log.info('Connected to mqtt %s' % userdata['host'])
+    userdata['connected'] = True
+    userdata['connects'] += 1
+    userdata['subscriptions'] = 1
+    # The portals of the broker are subscribed to as their serial appears.
+    for t, c in list(self._keepalive.items()):
+        if c is client:
+            del self._keepalive[t]
+    client.subscribe('N/+/system/0/Serial')
 
    def on_disconnect(self, client, userdata, rc):
-    log.info('Disconnected from mqtt')
+    log.info('Disconnected from mqtt %s' % userdata['host'])
+    userdata['connected'] = False
 
    def on_subscribe(self, client, userdata, flags, rc):
     log.info('MQTT subscription successful.')
 
    def on_message(self, client, userdata, msg):
     #print(msg.topic, msg.payload)
-    self._stats['msg']['count'] += 1
+    self._stats['msg']['count'].inc()
+    if userdata is not None:
+        userdata['msg'] += 1
+    if self._capture:
+        self._capture.mqtt(msg.topic, msg.payload)
     t = msg.topic
-    p = t.split('/')
-    m = '.'.join(p[4:])
-    if msg.payload:
-        j = json.loads(msg.payload)
-        if type(j) == dict and 'value' in j:
-           v = j['value']
-        else:
-           v = None
-    else:
-        v = None
-    if t.endswith('system/0/Serial'):
-        self._keepalive.add('R/' + v + '/system/0/Serial')
+    # Classify the topic first, the payload of most of the traffic on
+    # N/# is never decoded.
+    series = self._topics.lookup(t)
+    if series is None:
+        if t.endswith('system/0/Serial'):
+            v = decode_value(msg.payload)
+            if type(v) == str:
+                self.add_portal(client, userdata, v)
+            return
+        elif t.endswith('keepalive'):
+            return
+        self._stats['msg']['ignored'].inc()
         return
-    elif t.endswith('keepalive'):
-       return
 
-    if type(v) in [float, int, bool] and self.allowed(t):
-        v = float(v)
-    elif type(v) in [str] and self.allowed(t):
+    v = decode_value(msg.payload)
+    if type(v) in [float, int, bool]:
+        v = float(v)  # automatic conversion sometimes makes it an int
+    elif type(v) in [str]:
         pass
     else:
-        self._stats['msg']['ignored'] += 1
+        self._stats['msg']['ignored'].inc()
         if type(v) == type(None):
             pass
         elif t not in self._msg_seen:
@@ -203,32 +381,25 @@ class MqttToIngest:
         else:
             log.debug('Ignoring %s of type %s' % (t, type(v)))
         return
-    # print(m, v)
-    point = {
-        "measurement": m,
-        "tags": {
-            "path": p[2],
-            "instanceNumber": p[3] if len(p) > 3 else "",
-            "portalId": p[1]
-        },
-        "time": datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ'),
-        "fields": {
-            # value
-            # text
-        }
-    }
-    if type(v) == float:
-        v = float(v)  # automatic conversion sometimes makes it an int
-        point['fields']['value'] = v
-    elif type(v) == str:
-        point['fields']['text'] = v
+    # print(series, v)
+    if not self._points.add(series, v):
+        self._stats['msg']['dropped'].inc()
+    else:
+        self._stats['msg']['accepted'].inc()
 
-    try:
-        self._points.put(point, block=False)
-    except queue.Full:
-        log.error('Queue full, overload? - dropping all')
-        self._stats['msg']['dropped'] += self._points.qsize()
-        self._points.clear()
+   def add_portal(self, client, userdata, portal):
+    """Subscribe to the logged topics of a portal new on client."""
+    topic = 'R/%s/keepalive' % portal
+    if client is None or self._keepalive.get(topic) is client:
+        return
+    filters = topic_filters(portal)
+    client.subscribe([(f, 0) for f in filters])
+    # Without options the keepalive makes the GX publish all values.
+    client.publish(topic)
+    self._keepalive[topic] = client
+    userdata['subscriptions'] += len(filters)
+    log.info('Subscribed to %d topics of portal %s, paths up to %d levels deep' % (
+        len(filters), portal, PATH_DEPTH))
 
    def safe_keepalive(self):
        try:
@@ -244,131 +415,71 @@ class MqttToIngest:
        while not self._keepalive:
            time.sleep(.1)
        n = 0
-       interval = 30
        while self._active:
-           for t in self._keepalive:
-               log.info('Send keepalive to %s' % t)
-               #self._mqtt.publish(t, json.dumps(['+']))
-               self._mqtt.publish(t)
-           n += 1
-           if n >= (3600/interval):
-               n = 0
-               # Disconnect a reconnect, which forces
-               # a publish of all values every 5 minutes.
-               self._mqtt.disconnect()
-           time.sleep(interval)
+           n = self.send_keepalive(n)
+           time.sleep(KEEPALIVE)
+
+   async def keepalive_async(self):
+       while not self._keepalive:
+           await asyncio.sleep(.1)
+       n = 0
+       while self._active:
+           n = self.send_keepalive(n)
+           await asyncio.sleep(KEEPALIVE)
+
+   def send_keepalive(self, n):
+       """Publish the keepalives, return the next keepalive count."""
+       for t, client in list(self._keepalive.items()):
+           log.info('Send keepalive to %s' % t)
+           client.publish(t, KEEPALIVE_PAYLOAD)
+       n += 1
+       if n >= (3600/KEEPALIVE):
+           n = 0
+           # This used to disconnect every hour to force a publish of
+           # all values, the refresher reads the stale series instead.
+           if self._refresher:
+               self._refresher.count_republish()
+       return n
+
+   def read_client(self, portal):
+       """Return the client connected to portal or None."""
+       return self._keepalive.get('R/%s/keepalive' % portal)
 
    def safe_write(self):
        try:
-           self.write()
+           self.write_loop()
        except Exception as e:
            log.error('Write Exception %s' % type(e))
            traceback.print_exc()
        self.quit()
 
-   def write(self):
-      deduped = 0
-      unchanged = 0
-      points = defaultdict(list)
-      agg = defaultdict(dict)
-      changed = dict()
-      timer = datetime.utcnow()
-      timer = timer - timedelta(seconds=timer.second % INTERVAL,
-                             microseconds=timer.microsecond)
-      timer = timer + timedelta(seconds=INTERVAL)
-      unchanged_timer = timer + timedelta(hours=1)
+   def write_loop(self):
+      scheduler = self._scheduler
+      while self._active:
+        # Sleep until the end of the interval, quit() wakes us early.
+        self._wakeup.wait(scheduler.delay())
+        closed = scheduler.fire()
+        if closed is not None:
+            self.write(*closed)
+
+   async def write_loop_async(self):
+      scheduler = self._scheduler
       while self._active:
-        now = time.time()
         try:
-            p = self._points.get(timeout=1)
-            k = p['measurement'] + '.' + p['tags']['path'] + '.' + p['tags']['portalId'] + '.' + p['tags']['instanceNumber']
-            parts = p['measurement'].split('.')
-            i = None
-            if 'L1' in parts:
-                i = parts.index('L1')
-            if 'L2' in parts:
-                i = parts.index('L2')
-            if 'L3' in parts:
-                i = parts.index('L3')
-            if i is not None:
-                what = parts[i+1]
-                ks = k.replace('L1', 'Lx').replace('L2', 'Lx').replace('L3', 'Lx')
-                # print(ks, what)
-                if what in ('Power', 'Current', 'Voltage', 'Energy', 'I', 'P', 'V'):
-                    agg[ks][parts[i]] = p
-                #else:
-                #    print('ignored', what, ks)
-                if len(agg[ks]) == 3:
-                    ps = p.copy()
-                    ps['measurement'] = ps['measurement'].replace('L1', 'Lx').replace('L2', 'Lx').replace('L3', 'Lx')
-                    ps['fields']['value'] = sum(v['fields']['value'] for v in agg[ks].values())
-                    if what == 'Voltage' or what == 'V':
-                        ps['fields']['value'] /= 3
-                    # print('new sum', ks, what, ps['fields']['value'])
-                    points[ks].append(ps)
-                    del agg[ks]
-
-                
-            points[k].append(p)
-        except queue.Empty:
+            await asyncio.wait_for(self._done.wait(), scheduler.delay())
+        except asyncio.TimeoutError:
             pass
-
-        now = datetime.utcnow()
-        if unchanged_timer <= now:
-            unchanged_timer = timer + timedelta(hours=1)
-            changed = dict()
-            log.info('Flush unchanged cache')
-
-        if timer <= now:
-            # this is slightly wrong and should be corrected by INTERVAL/2
-            # also it would be nice to run this on a full 10s interval
-            interval = now - timer
-            dt = timer.strftime('%Y-%m-%dT%H:%M:%SZ')
-            timer = timer + timedelta(seconds=INTERVAL, microseconds=0)
-            if points:
-                tbw = []
-                duped = 0
-                unchanged = 0
-                for k, ms in points.items():
-                    # These are sampled on every datapoint
-                    #if '.Power.' in k or 'Dc.0.Current' in k or 'Dc.0.Voltage' in k:
-                    #   tbw += ms
-                    #    continue
-                    # Everything else is aggregated to a mean value
-                    if ms[0]['fields'].get('value', None) is not None:
-                        value = sum(v['fields']['value'] for v in ms) / len(ms)
-                        ms[0]['fields']['value'] = value
-                    elif ms[0]['fields'].get('text', None) is not None:
-                        # Don't need to do anything, just take the first value
-                        # TODO(jdi): Should be mode probably.
-                        value = ms[0]['fields'].get('text', None)
-                        pass
-                    duped += len(ms) - 1
-                    ms[0]['time'] = dt
-                    if k in changed and changed[k] == value:
-                      unchanged += 1
-                    else:
-                      tbw.append(ms[0])
-                      changed[k] = value
-                log.info('Write %d points (across %d unique measurements), Deduped %d, Unchanged %d, Interval %.3fs' % (
-                    len(tbw), len(points), duped, unchanged, interval.total_seconds()))
-                # print(points.keys())
-                if not self._dryrun:
-                    latency = time.time()
-                    try:
-                        self.write_points(tbw)
-                        self._stats['ingest']['writes'] += 1
-                    except requests.exceptions.RequestException as e:
-                        log.error('Write failure %s, dropping: %d' % (type(e), len(tbw)))
-                        self._stats['msg']['failed'] += len(tbw)
-                        self._stats['ingest']['failed'] += 1
-                    latency = time.time() - latency
-                    self._stats['ingest']['latency'] = (latency + 9*self._stats['ingest']['latency'])/10
-                    log.info('Latency %dms' % (latency*1000))
-                else:
-                    log.debug('  Skip write due to dryrun.')
-                points = defaultdict(list)
-            log.info('Messages handled: %s' % (self._stats['msg']))
+        closed = scheduler.fire()
+        if closed is not None:
+            self.write(*closed)
+
+   def write(self, start, end):
+      points = super().write(start, end)
+      if self._refresher:
+          self._refresher.seen(points, end)
+          self._refresher.refresh(end, self.read_client)
+      if self.on_flush:
+          self.on_flush(self._stats)
 
 def main():
     root = logging.getLogger()
@@ -385,19 +496,29 @@ def main():
     import argparse
     parser = argparse.ArgumentParser(
             description='Bridge MQTT messages from Venus GX to a compatible HTTP server with some smart sampling..')
-    parser.add_argument('--dryrun', action='store_true',
-                        help='do not publish values')
+    add_pipeline_args(parser)
     parser.add_argument('--mqtt_host', help='MQTT host to connect to', default='127.0.0.1')
-    parser.add_argument('--ingest_host', help='Ingestion host to connect to', default='127.0.0.1')
-    parser.add_argument('--port', help='Status report port', default=8071)
-    parser.add_argument('--token', help='Token to authorize ingestion', default=os.getenv('TOKEN', socket.gethostname()))
+    parser.add_argument('--refresh_after', help='Seconds after which a series not received is read '
+                        'from the GX again, 0 to disable', type=int, default=3600)
+    parser.add_argument('--refresh_rate', help='Maximum reads of stale series per second',
+                        type=float, default=5)
+    parser.add_argument('--runtime', help='Run the MQTT clients, flushes and uploads on threads '
+                        'or on one asyncio event loop', choices=RUNTIMES, default='threads')
+    parser.add_argument('--fleet', help='File with the MQTT brokers of many GX devices to bridge, '
+                        'one "host[:port] [portal_id]" per line, instead of --mqtt_host')
+    parser.add_argument('--fleet_workers', help='Worker processes the fleet is sharded across',
+                        type=int, default=os.cpu_count() or 1)
+    parser.add_argument('--port', help='Status report port (fleet workers: the following ports)', default=8071)
 
     args = parser.parse_args()
-    if args.dryrun:
-        log.warning('Running in dryrun mode')
-
-    MqttToIngest(mqtt_host=args.mqtt_host, ingest_host=args.ingest_host,
-                 token=args.token,
-                 dryrun=args.dryrun, stats_port=int(args.port))
+    kwargs = pipeline_options(parser, args, INTERVAL)
+    kwargs.update(runtime=args.runtime, refresh_after=args.refresh_after,
+                  refresh_rate=args.refresh_rate)
+    if args.fleet:
+        run_fleet(read_fleet(args.fleet), args.fleet_workers, int(args.port), kwargs)
+    else:
+        MqttToIngest(mqtt_host=args.mqtt_host, stats_port=int(args.port),
+                     **kwargs).run()
 
-main()
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,123 @@
+"""
+Replay a capture taken with --capture through a bridge, offline.
+
+The messages are fed to the message handler of the bridge at their
+captured pace (--speed 1), N times faster (--speed N) or as fast as
+possible (--speed 0). The intervals are flushed on a virtual clock
+following the captured timestamps, so the aggregation is the same at
+any speed. Nothing is uploaded; the written points can be saved in the
+line protocol with --output to compare the output of two versions:
+
+    python3 venus_replay.py storm.cap --speed 0 --output before.lp
+"""
+
+import argparse
+import logging
+import sys
+import time
+
+from venus_capture import DBUS, CaptureReader, dbus_call
+from venus_common import LineFormat
+
+log = logging.getLogger('replay')
+
+
+class Message:
+    """The attributes of a paho MQTTMessage the bridge reads."""
+
+    __slots__ = ('topic', 'payload')
+
+    def __init__(self, topic, payload):
+        self.topic = topic
+        self.payload = payload
+
+
+class Recorder:
+    """Takes the place of the BatchSender, optionally saves the points."""
+
+    def __init__(self, output=None):
+        self._output = output
+        self._format = LineFormat('ms')
+        self.batches = 0
+        self.points = 0
+
+    def submit(self, points, rp=None):
+        self.batches += 1
+        self.points += len(points)
+        if self._output and points:
+            if rp:
+                self._output.write('# rp=%s\n' % rp)
+            # Batches are not terminated by a newline.
+            self._output.write(self._format.serialize(points).decode() + '\n')
+        return True
+
+
+def make_bridge(kind, args):
+    if kind == DBUS:
+        from venus_dbus_influx import INTERVAL, DbusToIngest
+        bridge = DbusToIngest(args.portal_id, tiers=args.tiers)
+        feed = lambda topic, body: bridge.value_changed_on_dbus(*dbus_call(topic, body))
+    else:
+        from venus_mqtt_influx import INTERVAL, MqttToIngest
+        bridge = MqttToIngest(tiers=args.tiers)
+        feed = lambda topic, body: bridge.on_message(None, None, Message(topic, body))
+    return bridge, feed, INTERVAL
+
+
+def replay(reader, args, output=None):
+    bridge = feed = None
+    recorder = Recorder(output)
+    records = 0
+    started = time.monotonic()
+    for kind, t, topic, body in reader:
+        if bridge is None:
+            bridge, feed, interval = make_bridge(kind, args)
+            bridge._uploader = recorder
+            start = reader.start_time + t
+            deadline = start - start % interval + interval
+        now = reader.start_time + t
+        while now >= deadline:
+            bridge.write(deadline - interval, deadline)
+            deadline += interval
+        if args.speed:
+            delay = t / args.speed - (time.monotonic() - started)
+            if delay > 0:
+                time.sleep(delay)
+        feed(topic, bytes(body))
+        records += 1
+    if bridge is not None:
+        bridge.write(deadline - interval, deadline)
+    elapsed = time.monotonic() - started
+    return records, elapsed, recorder
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Replay a capture through a bridge.')
+    parser.add_argument('capture', help='Capture file written with --capture')
+    parser.add_argument('--speed', help='Replay speed, 1 is real time, 0 as fast as possible',
+                        type=float, default=0)
+    parser.add_argument('--output', help='Save the written points in line protocol to this file')
+    parser.add_argument('--portal_id', help='Portal ID of a dbus capture', default='replay')
+    parser.add_argument('--verbose', action='store_true', help='log like the bridge does')
+    args = parser.parse_args()
+    args.tiers = None
+
+    logging.basicConfig(stream=sys.stdout,
+                        level=logging.INFO if args.verbose else logging.WARNING,
+                        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+
+    reader = CaptureReader(args.capture)
+    output = open(args.output, 'w') if args.output else None
+    try:
+        records, elapsed, recorder = replay(reader, args, output)
+    finally:
+        reader.close()
+        if output:
+            output.close()
+    print('Replayed %d messages in %.2fs (%d msgs/s), wrote %d points in %d batches' % (
+        records, elapsed, records / max(elapsed, 1e-9), recorder.points,
+        recorder.batches))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,241 @@
+"""
+Disk backed spool for payloads the ingest host did not accept.
+
+Payloads are appended to segment files in a spool directory, which is
+written strictly sequentially to be gentle on the flash of a GX device.
+The spool is capped in size and age, the oldest segments are dropped
+first. A replay thread drains the spool oldest first at a limited rate
+once the ingest host accepts writes again.
+"""
+
+import logging
+import os
+import struct
+import threading
+import time
+import zlib
+
+from venus_common import IngestError
+
+log = logging.getLogger('spool')
+
+# length, crc32, creation time, content type length, path length
+HEADER = struct.Struct('<IIdHH')
+SUFFIX = '.spool'
+
+
+class Spool:
+
+    def __init__(self, directory, max_bytes=50*1024*1024, max_age=7*86400,
+                 segment_bytes=1024*1024, stats=None):
+        self._dir = directory
+        self._max_bytes = max_bytes
+        self._max_age = max_age
+        self._segment_bytes = segment_bytes
+        self._lock = threading.Lock()
+        self._file = None
+        self._file_name = None
+        self.stats = stats if stats is not None else {}
+        self.stats.update({
+            'depth': 0,
+            'bytes': 0,
+            'segments': 0,
+            'spooled': 0,
+            'dropped': 0,
+            'replayed': 0,
+            'replay_rate': 0,
+        })
+        os.makedirs(directory, exist_ok=True)
+        self._segments = []
+        self._sizes = {}
+        self._counts = {}
+        for name in sorted(os.listdir(directory)):
+            if not name.endswith(SUFFIX):
+                continue
+            path = os.path.join(directory, name)
+            self._segments.append(path)
+            self._sizes[path] = os.path.getsize(path)
+            self._counts[path] = sum(1 for _ in self.read(path))
+        self._seq = 0
+        if self._segments:
+            self._seq = int(os.path.basename(self._segments[-1])[:-len(SUFFIX)]) + 1
+        self._update_stats()
+        if self._segments:
+            log.info('Spool %s holds %d payloads in %d segments' % (
+                directory, self.stats['depth'], len(self._segments)))
+
+    def _update_stats(self):
+        self.stats['depth'] = sum(self._counts.values())
+        self.stats['bytes'] = sum(self._sizes.values())
+        self.stats['segments'] = len(self._segments)
+
+    def __len__(self):
+        return self.stats['depth']
+
+    def _roll(self):
+        if self._file:
+            self._file.close()
+        self._file = None
+        self._file_name = None
+
+    def append(self, body, content_type, path=''):
+        ct = content_type.encode()
+        p = path.encode()
+        record = HEADER.pack(len(body), zlib.crc32(body), time.time(),
+                             len(ct), len(p)) + ct + p + body
+        with self._lock:
+            if self._file is None or self._sizes[self._file_name] >= self._segment_bytes:
+                self._roll()
+                self._file_name = os.path.join(
+                        self._dir, '%012d%s' % (self._seq, SUFFIX))
+                self._seq += 1
+                self._file = open(self._file_name, 'ab')
+                self._segments.append(self._file_name)
+                self._sizes[self._file_name] = 0
+                self._counts[self._file_name] = 0
+            self._file.write(record)
+            self._file.flush()
+            self._sizes[self._file_name] += len(record)
+            self._counts[self._file_name] += 1
+            self.stats['spooled'] += 1
+            self._expire()
+            self._update_stats()
+
+    def _expire(self):
+        # Keep the newest segment, it is the one being written.
+        oldest = time.time() - self._max_age
+        while len(self._segments) > 1 and (
+                sum(self._sizes.values()) > self._max_bytes or
+                os.path.getmtime(self._segments[0]) < oldest):
+            self._drop(self._segments[0])
+
+    def _drop(self, path):
+        log.warning('Dropping spool segment %s with %d payloads' % (
+            path, self._counts[path]))
+        self.stats['dropped'] += self._counts[path]
+        self._remove(path)
+
+    def _remove(self, path):
+        if path == self._file_name:
+            self._roll()
+        self._segments.remove(path)
+        del self._sizes[path]
+        del self._counts[path]
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
+
+    def oldest(self):
+        """Return the oldest segment, closing it if it is still written."""
+        with self._lock:
+            if not self._segments:
+                return None
+            path = self._segments[0]
+            if path == self._file_name:
+                self._roll()
+            return path
+
+    def remove(self, path):
+        with self._lock:
+            if path in self._sizes:
+                self._remove(path)
+                self._update_stats()
+
+    def consumed(self, path):
+        with self._lock:
+            if path in self._counts:
+                self._counts[path] = max(0, self._counts[path] - 1)
+                self._update_stats()
+
+    def read(self, path, offset=0):
+        """Yield (next offset, creation time, content type, path, body)."""
+        with open(path, 'rb') as f:
+            f.seek(offset)
+            while True:
+                header = f.read(HEADER.size)
+                if len(header) < HEADER.size:
+                    return
+                length, crc, created, ct_len, p_len = HEADER.unpack(header)
+                meta = f.read(ct_len + p_len)
+                body = f.read(length)
+                if len(body) < length or zlib.crc32(body) != crc:
+                    # Torn write at the end of a segment, e.g. on power loss.
+                    log.warning('Corrupt record in %s at %d' % (path, offset))
+                    return
+                offset = f.tell()
+                yield (offset, created, meta[:ct_len].decode(),
+                       meta[ct_len:].decode(), body)
+
+    def expired(self, created):
+        return created < time.time() - self._max_age
+
+
+class SpoolReplayer:
+    """Drains a spool through the ingest sender once it works again."""
+
+    def __init__(self, spool, sender, rate=2, retry=30):
+        self._spool = spool
+        self._sender = sender
+        self._interval = 1.0 / rate
+        self._retry = retry
+        self._offsets = {}
+        self.healthy = True
+        self.failed = 0
+        self._wake = threading.Event()
+        self._thread = threading.Thread(target=self.run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def report(self, ok):
+        """Called with the result of every live upload."""
+        if ok and not self.healthy:
+            self.healthy = True
+            self._wake.set()
+        elif not ok:
+            self.healthy = False
+            self.failed = time.time()
+
+    def run(self):
+        while True:
+            try:
+                self.replay()
+            except Exception as e:
+                log.error('Replay Exception %s' % e)
+            self._wake.wait(self._retry)
+            self._wake.clear()
+
+    def replay(self):
+        stats = self._spool.stats
+        while len(self._spool):
+            if not self.healthy and time.time() - self.failed < self._retry:
+                return
+            path = self._spool.oldest()
+            if path is None:
+                return
+            offset = self._offsets.pop(path, 0)
+            for next_offset, created, ct, p, body in self._spool.read(path, offset):
+                if not self._spool.expired(created):
+                    start = time.time()
+                    try:
+                        self._sender.post(body, ct, path=p or None)
+                    except IngestError as e:
+                        if e.retryable:
+                            log.info('Replay failed %s, retry in %ds' % (e, self._retry))
+                            self._offsets[path] = offset
+                            self.report(False)
+                            return
+                        log.error('Replay rejected %s, skipping' % e)
+                        stats['dropped'] += 1
+                    else:
+                        stats['replayed'] += 1
+                    self.healthy = True
+                    elapsed = time.time() - start
+                    rate = 1 / max(elapsed, self._interval)
+                    stats['replay_rate'] = (rate + 9*stats['replay_rate'])/10
+                    time.sleep(max(0, self._interval - elapsed))
+                offset = next_offset
+                self._spool.consumed(path)
+            log.info('Replayed spool segment %s' % path)
+            self._spool.remove(path)
+        stats['replay_rate'] = 0